@@ -0,0 +1,155 @@
+import numpy as np
+from scorer import top_n_indices
+
+def augment_movies(movie_embedding, movie_bias):
+    # Fold the bias in as an extra dimension, then add one more so every movie has the same norm:
+    # the largest inner products with [user, 1, 0] are then the nearest movies by cosine
+    vectors = np.hstack([movie_embedding, movie_bias.reshape(-1, 1)]).astype(np.float32)
+    norms = np.einsum('ij,ij->i', vectors, vectors)
+    max_norm = norms.max() if len(norms) else 1.0
+    extra = np.sqrt(np.maximum(max_norm - norms, 0.0)).reshape(-1, 1)
+    return np.hstack([vectors, extra]) / np.sqrt(max(max_norm, 1e-12))
+
+def augment_user(user_vector):
+    return np.concatenate([user_vector, [1.0, 0.0]]).astype(np.float32)
+
+def assign_clusters(points, centroids, block_size = 65536):
+    # Closest centroid by inner product, blocked to bound the points x centroids matrix
+    return np.concatenate([
+        np.argmax(points[start:start + block_size] @ centroids.T, axis = 1)
+        for start in range(0, len(points), block_size)]) if len(points) else np.empty(0, dtype = np.int64)
+
+def spherical_kmeans(points, num_clusters, iterations, rng):
+    centroids = points[rng.choice(len(points), num_clusters, replace = False)]
+    for _ in range(iterations):
+        assignment = assign_clusters(points, centroids)
+
+        # Sum of the points of each cluster, sorted once instead of a scatter add per point
+        order = np.argsort(assignment, kind = 'stable')
+        counts = np.bincount(assignment, minlength = num_clusters)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        non_empty = counts > 0
+        sums[non_empty] = np.add.reduceat(points[order], starts[non_empty], axis = 0)
+
+        # Empty clusters restart from random points
+        empty = np.flatnonzero(~non_empty)
+        sums[empty] = points[rng.choice(len(points), len(empty), replace = False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis = 1, keepdims = True), 1e-12)
+    return centroids.astype(np.float32)
+
+class IVFIndex:
+    # Inverted lists scanned per query, more lists give better recall for more latency
+    n_probe = 16
+
+    def __init__(self, centroids, list_offsets, list_items):
+        # Movies of list j are list_items[list_offsets[j]:list_offsets[j + 1]]
+        self.centroids = np.asarray(centroids, dtype = np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype = np.int64)
+        self.list_items = np.asarray(list_items, dtype = np.int32)
+
+    @classmethod
+    def from_embeddings(cls, movie_embedding, movie_bias, num_lists = None, iterations = 10, sample_size = 64, seed = 0):
+        points = augment_movies(movie_embedding, movie_bias)
+        num_lists = min(num_lists or max(1, int(4 * np.sqrt(len(points)))), len(points))
+        if num_lists == 0:
+            return cls(np.zeros((0, points.shape[1])), np.zeros(1, dtype = np.int64), np.empty(0, dtype = np.int32))
+
+        # Train the centroids on a sample of about sample_size movies per list, then assign every movie
+        rng = np.random.default_rng(seed)
+        sample = points[rng.choice(len(points), min(len(points), num_lists * sample_size), replace = False)]
+        centroids = spherical_kmeans(sample, num_lists, iterations, rng)
+        assignment = assign_clusters(points, centroids)
+
+        list_items = np.argsort(assignment, kind = 'stable').astype(np.int32)
+        list_offsets = np.zeros(num_lists + 1, dtype = np.int64)
+        np.cumsum(np.bincount(assignment, minlength = num_lists), out = list_offsets[1:])
+        return cls(centroids, list_offsets, list_items)
+
+    def with_movies(self, movie_embedding, movie_bias):
+        # Copy of the index with the movies past the indexed ones added to their closest lists, the centroids are kept
+        start = len(self.list_items)
+        if start >= len(movie_embedding) or self.num_lists == 0:
+            return self
+        points = augment_movies(movie_embedding, movie_bias)[start:]
+        assignment = np.concatenate([
+            np.repeat(np.arange(self.num_lists), np.diff(self.list_offsets)),
+            assign_clusters(points, self.centroids)])
+        items = np.concatenate([self.list_items, np.arange(start, len(movie_embedding), dtype = np.int32)])
+        list_offsets = np.zeros(self.num_lists + 1, dtype = np.int64)
+        np.cumsum(np.bincount(assignment, minlength = self.num_lists), out = list_offsets[1:])
+        return IVFIndex(self.centroids, list_offsets, items[np.argsort(assignment, kind = 'stable')])
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    @property
+    def nbytes(self):
+        return self.centroids.nbytes + self.list_offsets.nbytes + self.list_items.nbytes
+
+    def candidates(self, user_vector, n_probe = None):
+        # Movies of the n_probe lists whose centroids score highest for the user
+        n_probe = min(n_probe or self.n_probe, self.num_lists)
+        list_scores = self.centroids @ augment_user(user_vector)
+        lists = np.argpartition(list_scores, -n_probe)[-n_probe:] if n_probe < self.num_lists else np.arange(self.num_lists)
+        offsets = self.list_offsets
+        return np.concatenate([self.list_items[offsets[j]:offsets[j + 1]] for j in lists])
+
+    def top_n(self, scorer, user_vector, top_n = 10, exclude = None, n_probe = None):
+        # Exact scores of the candidates only, probing more lists while too few are left after exclusion
+        n_probe = n_probe or self.n_probe
+        while True:
+            # The index may already hold movies the trainer published after the request's scorer
+            candidates = self.candidates(user_vector, n_probe)
+            candidates = candidates[candidates < scorer.num_movies]
+            if exclude is not None:
+                candidates = candidates[~exclude[candidates]]
+            if len(candidates) >= top_n or n_probe >= self.num_lists:
+                break
+            n_probe *= 2
+
+        scores = scorer.movie_vectors(candidates) @ user_vector + scorer.movie_bias[candidates]
+        return candidates[top_n_indices(scores, top_n)]
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from scorer import EmbeddingScorer
+
+    # Recall@10 and latency against the exhaustive scorer, on the served model or a synthetic catalog of argv[1] movies
+    if len(sys.argv) > 1:
+        # Decaying spectrum like trained factorization embeddings, isotropic noise has no structure to index
+        rng = np.random.default_rng(0)
+        num_movies = int(sys.argv[1])
+        spectrum = 0.3 * 0.85 ** np.arange(50)
+        scorer = EmbeddingScorer(
+            rng.normal(0, 1, (1000, 50)) * spectrum, rng.normal(0, 0.1, 1000),
+            rng.normal(0, 1, (num_movies, 50)) * spectrum, rng.normal(0, 0.3, num_movies))
+        exclude_of = lambda user_encoded: None
+    else:
+        from utilities import registry, movies_not_recommendable
+        scorer = registry.get('scorer')
+        user_encoded2user = registry.get('state').user_encoded2user
+        exclude_of = lambda user_encoded: movies_not_recommendable(user_encoded2user[user_encoded], scorer)
+
+    start = time.perf_counter()
+    index = IVFIndex.from_embeddings(scorer.movie_embedding, scorer.movie_bias)
+    print(f"{scorer.num_movies} movies, {index.num_lists} lists, built in {time.perf_counter() - start:.2f}s, {index.nbytes / 1e6:.1f} MB")
+
+    users = range(min(scorer.num_users, 500))
+    excludes = [exclude_of(x) for x in users]
+    start = time.perf_counter()
+    exact = [scorer.top_n(x, 10, exclude = exclude) for x, exclude in zip(users, excludes)]
+    exact_ms = (time.perf_counter() - start) / len(users) * 1e3
+    print(f"exhaustive: {exact_ms:.3f} ms/user")
+
+    for n_probe in [1, 2, 4, 8, 16, 32, 64]:
+        if n_probe > index.num_lists:
+            break
+        start = time.perf_counter()
+        approx = [index.top_n(scorer, scorer.user_embedding[x], 10, exclude = exclude, n_probe = n_probe) for x, exclude in zip(users, excludes)]
+        approx_ms = (time.perf_counter() - start) / len(users) * 1e3
+        recall = np.mean([len(np.intersect1d(x, y)) / max(len(x), 1) for x, y in zip(exact, approx)])
+        print(f"n_probe {n_probe:>3}: recall@10 {recall:.3f}, {approx_ms:.3f} ms/user ({exact_ms / approx_ms:.1f}x), "
+              f"{n_probe / index.num_lists:.1%} of lists")
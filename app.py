@@ -1,28 +1,179 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, tuple_, delete, update, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
 from flask_marshmallow import Marshmallow
 import os
-import json
+import sqlite3
+import sys
+import threading
+import time
 import pandas as pd
 from utilities import predict_new_user
 from utilities import predict_user_has_rating
+from utilities import predict_users_batch
+from utilities import registry
+from utilities import reload_snapshot
+from utilities import start_online_training
+from utilities import batcher
 from utilities import get_all_movies_has_rating
+from utilities import best_rated_movies
 from utilities import get_movies_by_genre_utilities
+from utilities import get_similar_movies
+from utilities import search_movies
+from utilities import add_catalog_movie
+from utilities import normalize_genres
+from utilities import rating_change_tags
+from utilities import apply_changes
+from utilities import change_feed
+from utilities import create_change_log
+from utilities import structure_sizes
+from cache import ResponseCache
+from serializers import movie_records, dumps, json_response
+from seed import seed_cli
+from snapshot import snapshot_cli
+from precompute import precompute_cli
+from metrics import metrics, server_timing, resident_memory, PrometheusText, SamplingProfiler
+from offload import Offload
 
 # Init app
 app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 # Database
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'db.sqlite')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(os.environ.get('DB_PATH', os.path.join(basedir, 'db.sqlite')))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Connections kept open per process, SQLite waits up to the timeout for a writer instead of failing with 'database is locked'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 8)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 8)),
+    'pool_timeout': 10,
+    'connect_args': {'timeout': 15, 'check_same_thread': False},
+}
+
 # Init db
 db = SQLAlchemy(app)
 
+# WAL lets reads go on while a write is committing, every connection gets the same settings;
+# a read only database (the serverless deployment) can not be switched and is read in its own journal mode
+def configure_connection(connection, _):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('PRAGMA journal_mode = WAL')
+    except sqlite3.OperationalError:
+        pass
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = 15000')
+    cursor.execute('PRAGMA cache_size = -65536')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+# Time spent in SQLite by the ORM queries, reported with the stages of the request
+def start_statement(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('statement_start', []).append(time.perf_counter())
+
+def end_statement(connection, cursor, statement, parameters, context, executemany):
+    metrics.observe_stage('sqlite', time.perf_counter() - connection.info['statement_start'].pop())
+
+with app.app_context():
+    event.listen(db.engine, 'connect', configure_connection)
+    event.listen(db.engine, 'before_cursor_execute', start_statement)
+    event.listen(db.engine, 'after_cursor_execute', end_statement)
+
 # Init marshmallow
 ma = Marshmallow(app)
 
+# Bulk import commands: flask seed users|movies|ratings|all
+app.cli.add_command(seed_cli)
+
+# Snapshot commands: flask snapshot compile|publish|list
+app.cli.add_command(snapshot_cli)
+
+# Offline top movies of every user: flask precompute
+app.cli.add_command(precompute_cli)
+
+# Init response cache, entries are dropped when the ratings they depend on change
+response_cache = ResponseCache(
+    max_entries = int(os.environ.get('RESPONSE_CACHE_SIZE', 4096)),
+    ttl = float(os.environ.get('RESPONSE_CACHE_TTL', 300)))
+
+# Requests with ?profile=1 or an X-Profile header are sampled into folded stacks under PROFILE_DIR, when PROFILE_REQUESTS=1
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(basedir, 'profiles'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', 1)) / 1000
+
+# Latency and stage timings of every request, the stages are also returned in a Server-Timing header
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+    if PROFILE_REQUESTS and (request.args.get('profile') == '1' or 'X-Profile' in request.headers):
+        g.profiler = SamplingProfiler(threading.get_ident(), interval = PROFILE_INTERVAL).__enter__()
+
+@app.after_request
+def end_request_metrics(response):
+    seconds = time.perf_counter() - g.request_start
+    timings = metrics.end_request(request.endpoint or 'unmatched', request.method, response.status_code, seconds)
+    response.headers['Server-Timing'] = server_timing({**timings, 'total': seconds})
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.__exit__(None, None, None)
+        os.makedirs(PROFILE_DIR, exist_ok = True)
+        path = os.path.join(PROFILE_DIR, f'{time.time():.3f}-{request.endpoint}.folded')
+        with open(path, 'w') as profile_file:
+            profile_file.write(profiler.folded())
+        response.headers['X-Profile-File'] = path
+    return response
+
+# With RECOMMENDER_WORKERS set, recommendations are computed by that many pool threads so request threads stay free
+# for cheap lookups; calls beyond RECOMMENDER_QUEUE waiting ones, or slower than RECOMMENDER_DEADLINE_MS,
+# get the best rated movies instead
+offload = Offload(
+    max_workers = int(os.environ['RECOMMENDER_WORKERS']),
+    max_queued = int(os.environ.get('RECOMMENDER_QUEUE', 16)),
+    deadline = float(os.environ.get('RECOMMENDER_DEADLINE_MS', 1000)) / 1000) if os.environ.get('RECOMMENDER_WORKERS') else None
+
+def recommend(fn, *args, fallback, **kwargs):
+    # (result, None), or (fallback result, reason) when the offload pool turned the call away
+    if offload is None:
+        return fn(*args, **kwargs), None
+    return offload.run(fn, *args, fallback = fallback, **kwargs)
+
+def degraded_response(body, reason):
+    # Fallback answers are not cached and say why they were given
+    response = json_response(body)
+    response.headers['X-Degraded'] = reason
+    return response
+
+# The flask commands (seed, snapshot compile, precompute) import the app as well, only a server warms the engines and trains
+serving = os.environ.get('FLASK_RUN_FROM_CLI') != 'true' or 'run' in sys.argv[1:]
+
+# Build the recommender engines in the background, otherwise they are built by the first request using them
+if serving and os.environ.get('WARM_ENGINES', '1') == '1':
+    registry.warm()
+
+# Cached responses affected by changes applied from the change log, all of them after a rebuild
+def invalidate_changes(tags):
+    if tags is None:
+        response_cache.clear()
+    else:
+        response_cache.invalidate(tags)
+
+# Apply the rating and catalog changes of the other processes, and switch to newly published snapshots and precomputed tables
+if serving and os.environ.get('CHANGE_FEED', '1') == '1':
+    change_feed.start(on_change = invalidate_changes)
+
+# Train the embeddings on new ratings in the background, cached responses of the trained users are dropped
+def invalidate_trained(trained):
+    for user_id, movie_ids in trained.items():
+        response_cache.invalidate(rating_change_tags(user_id, movie_ids))
+
+if serving and os.environ.get('ONLINE_TRAINING') == '1':
+    start_online_training(on_publish = invalidate_trained)
+
 # User Model
 class User(db.Model):
     __tablename__ = 'user'
@@ -30,7 +181,6 @@ class User(db.Model):
     username = db.Column(db.String(50))
     email = db.Column(db.String(50))
     password = db.Column(db.String(50))
-    users = db.relationship('Movie', secondary = 'user_movie')
     user_movies = db.relationship('UserMovie', backref = 'user', lazy = True)
     
     def __init__(self, username, email, password):
@@ -45,7 +195,6 @@ class Movie(db.Model):
     movieTitle = db.Column(db.String(50))
     movieGenre = db.Column(db.String(50))
     movieImage = db.Column(db.String(300))
-    movies = db.relationship('User', secondary = 'user_movie')
     
     def __init__(self, movieTitle, movieGenre, movieImage):
         self.movieTitle = movieTitle
@@ -55,6 +204,10 @@ class Movie(db.Model):
 # UserMovie Model
 class UserMovie(db.Model):
     __tablename__ = 'user_movie'
+    __table_args__ = (
+        db.Index('ix_user_movie_movieId', 'movieId'),
+        db.Index('ix_user_movie_userId_rating', 'userId', 'rating'),
+    )
     userId = db.Column(db.Integer, db.ForeignKey('user.userId'), primary_key = True)
     movieId = db.Column(db.Integer, db.ForeignKey('movie.movieId'), primary_key = True)
     rating = db.Column(db.Float)
@@ -79,6 +232,22 @@ class UserMovieSchema(ma.Schema):
         fields = ('userId', 'movieId', 'rating', 'isFavorited', 'isWatched')
         model = UserMovie
 
+# Databases created before the secondary indexes get them on start, read only deployments go on without
+with app.app_context():
+    try:
+        for index in UserMovie.__table__.indexes:
+            index.create(db.engine, checkfirst = True)
+    except OperationalError:
+        pass
+create_change_log()
+
+# Rating changes committed by a request are read back from the change log together with the ones of the other processes,
+# in commit order, or applied directly when the database has no change log
+def apply_committed(changes):
+    recommender_state = registry.get('state')
+    if change_feed.poll(invalidate_changes) is None:
+        invalidate_changes(apply_changes(recommender_state, changes))
+
 # Init Schema
 user_schema = UserSchema()
 users_schema = UserSchema(many = True)
@@ -89,46 +258,82 @@ movies_schema = MovieSchema(many = True)
 usermovie_schema = UserMovieSchema()
 usermovies_schema = UserMovieSchema(many = True)
 
+# Results of one title search
+MAX_SEARCH_RESULTS = 100
+
+# Recommendations per user of one request
+MAX_RECOMMENDATIONS = 100
+
+# Users of one /predict/batch request
+MAX_BATCH_USERS = 1000
+
+# Keyset pagination of the listing endpoints
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+STREAM_CHUNK_SIZE = 1000
+
+def page_limit():
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type = int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def wants_stream():
+    return request.args.get('stream') in ('1', 'true') or request.accept_mimetypes.best == 'application/x-ndjson'
+
+def stream_rows(statement, fields):
+    # Yield NDJSON rows from a server side cursor, one chunk at a time
+    def generate():
+        result = db.session.execute(statement.execution_options(yield_per = STREAM_CHUNK_SIZE))
+        for rows in result.partitions():
+            yield b''.join(dumps(dict(zip(fields, row))) + b'\n' for row in rows)
+
+    return Response(stream_with_context(generate()), mimetype = 'application/x-ndjson')
+
 # route
 @app.route('/')
 def home():
     strHome = "Movie Database"
     return strHome
 
+# The process is up, even while the engines are still being built
+@app.route('/healthz', methods = ['GET'])
+def healthz():
+    return jsonify({'status': 'ok'})
+
+# Every recommender engine is built and requests will not wait on one
+@app.route('/readyz', methods = ['GET'])
+def readyz():
+    ready = registry.ready()
+    return jsonify({'ready': ready, 'engines': registry.status()}), 200 if ready else 503
+
 @app.route('/users', methods = ['GET'])
 def get_all_users():
-    # Get all users
-    users = User.query.all()
+    # Users after the cursor, ordered by primary key
+    after = request.args.get('after', 0, type = int)
+    fields = UserSchema.Meta.fields
+    statement = select(*[getattr(User, x) for x in fields]).where(User.userId > after).order_by(User.userId)
     
-    if not users:  # If no movies exist in the database
-        # Load data from the movies.json file
-        with open('./data/users.json') as json_file:
-            users_data = json.load(json_file)
-
-        # Save movies to the database
-        for user_data in users_data:
-            user = User(
-                userId = user_data['userId']
-            )
-
-            db.session.add(user)
-        
-        db.session.commit()
-        
-        # Retrieve movies from the database
-        users = Movie.query.all()
+    # Stream every remaining user as NDJSON
+    if wants_stream():
+        return stream_rows(statement, fields)
+    
+    # Get one page of users
+    limit = page_limit()
+    users = User.query.filter(User.userId > after).order_by(User.userId).limit(limit).all()
     
     # Serialize the user data using the users schema
     result = users_schema.dump(users)
     
-    # Return the serialized user as JSON response
-    return jsonify(result)
+    # Return the serialized user as JSON response, with the cursor of the next page
+    response = jsonify(result)
+    if len(users) == limit:
+        response.headers['X-Next-Cursor'] = str(users[-1].userId)
+    return response
 
 # Get user
 @app.route('/users/<int:user_id>', methods = ['GET'])
 def get_user(user_id):
-    # Get the user with the given ID from the database
-    user = User.query.get(user_id)
+    # Get the user with the given ID from the database, its ratings in a second query
+    user = db.session.get(User, user_id, options = [selectinload(User.user_movies)])
     
     if user:
         # Serialize the user data using the user schema
@@ -146,17 +351,18 @@ def get_user(user_id):
 # Get user
 @app.route('/users/<int:user_id>', methods = ['DELETE'])
 def delete_user(user_id):
-    # Get the user with the given ID from the database
-    user = User.query.get(user_id)
-    
-    if user:
-            # Delete the user_movie(s)
-            db.session.delete(user)
-            db.session.commit()
-            return jsonify({'message': 'User movies deleted successfully'}), 200
-    else:
-            # Return a 404 error if the user_movie is not found
-            return jsonify({'message': 'User not found'}), 404
+    # Delete the user, then its user_movie(s), one statement each; nothing is deleted for an unknown user
+    deleted = db.session.execute(delete(User).where(User.userId == user_id)).rowcount
+    if not deleted:
+        db.session.rollback()
+        return jsonify({'message': 'User not found'}), 404
+
+    movie_ids = db.session.scalars(delete(UserMovie).where(UserMovie.userId == user_id).returning(UserMovie.movieId)).all()
+    db.session.commit()
+
+    # Remove the ratings from the recommender
+    apply_committed([('deleted', user_id, x, None) for x in movie_ids])
+    return jsonify({'message': 'User movies deleted successfully'}), 200
     
 @app.route('/users', methods = ['POST'])
 def create_user():
@@ -255,33 +461,35 @@ def update_user(user_id):
 
 @app.route('/user_movies', methods = ['GET'])
 def get_all_user_movies():
-    # Get all user_movie
-    user_movies = UserMovie.query.all()
-    
-    if not user_movies:  # If no user_movies exist in the database
-        # Load data from the user_movies.json file
-        with open('./data/ratings.json') as json_file:
-            user_movies_data = json.load(json_file)
-
-        # Save user_movies to the database
-        for data in user_movies_data:
-            user_movie = UserMovie(
-                userId = data['userId'],
-                movieId = data['movieId'],
-                rating = data['rating']
-            )
-            db.session.add(user_movie)
-        
-        db.session.commit()
-        
-        # Retrieve user_movies from the database
-        user_movies = UserMovie.query.all()
+    # The cursor is the 'userId:movieId' primary key of the last row seen
+    try:
+        after = tuple(int(x) for x in request.args.get('after', '0:0').split(':'))
+        if len(after) != 2:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'after must be userId:movieId'}), 400
+    
+    # User_movies after the cursor, ordered by primary key
+    key = tuple_(UserMovie.userId, UserMovie.movieId)
+    fields = UserMovieSchema.Meta.fields
+    statement = select(*[getattr(UserMovie, x) for x in fields]).where(key > after).order_by(UserMovie.userId, UserMovie.movieId)
+    
+    # Stream every remaining user_movie as NDJSON
+    if wants_stream():
+        return stream_rows(statement, fields)
+    
+    # Get one page of user_movie
+    limit = page_limit()
+    user_movies = UserMovie.query.filter(key > after).order_by(UserMovie.userId, UserMovie.movieId).limit(limit).all()
     
     # Serialize the user_movie data using the user_movies schema
     result = usermovies_schema.dump(user_movies)
     
-    # REturn the serialized user_movie as JSON response
-    return jsonify(result)
+    # Return the serialized user_movie as JSON response, with the cursor of the next page
+    response = jsonify(result)
+    if len(user_movies) == limit:
+        response.headers['X-Next-Cursor'] = f'{user_movies[-1].userId}:{user_movies[-1].movieId}'
+    return response
 
 @app.route('/user_movies/<int:user_movie_id>', methods = ['GET'])
 def get_user_movie(user_movie_id):
@@ -301,13 +509,13 @@ def get_user_movie(user_movie_id):
 # DELETE
 @app.route('/user_movies/<int:user_movie_id>', methods = ['DELETE'])
 def delete_user_movie(user_movie_id):
-    user_movies = UserMovie.query.filter_by(userId = user_movie_id).all()
+    # Delete the user_movie(s) in one statement, returning the movies they rated
+    movie_ids = db.session.scalars(delete(UserMovie).where(UserMovie.userId == user_movie_id).returning(UserMovie.movieId)).all()
+    db.session.commit()
 
-    if user_movies:
-        # Delete the user_movie(s)
-        for user_movie in user_movies:
-            db.session.delete(user_movie)
-        db.session.commit()
+    if movie_ids:
+        # Remove the ratings from the recommender
+        apply_committed([('deleted', user_movie_id, x, None) for x in movie_ids])
         return jsonify({'message': 'User movies deleted successfully'}), 200
     else:
         # Return a 404 error if the user_movie is not found
@@ -334,6 +542,9 @@ def create_user_movie():
     # Commit the changes to the database
     db.session.commit()
     
+    # Apply the new rating to the recommender
+    apply_committed([('rating', userId, movieId, rating)])
+    
     # Serialize the new user_movie data using the user schema
     result = usermovie_schema.dump(new_user_movie)
     
@@ -351,22 +562,33 @@ def update_user_movie(user_movie_id):
     isFavorited = data.get('isFavorited')
     isWatched = data.get('isWatched')
     
-    # Get user_movie need to update
-    user_movie = UserMovie.query.filter_by(userId = user_movie_id, movieId = movieId).first()
-    
-    # Update user_movie
-    if movieId:
-        user_movie.movieId = movieId
+    # Fields to update
+    values = {}
     if rating:
-        user_movie.rating = rating
+        values['rating'] = rating
     if isFavorited:
-        user_movie.isFavorited = isFavorited
+        values['isFavorited'] = isFavorited
     if isWatched:
-        user_movie.isWatched = isWatched
+        values['isWatched'] = isWatched
+    
+    # Update user_movie in one statement, returning the updated row
+    columns = [getattr(UserMovie, x) for x in UserMovieSchema.Meta.fields]
+    key = (UserMovie.userId == user_movie_id, UserMovie.movieId == movieId)
+    if values:
+        statement = update(UserMovie).where(*key).values(**values).returning(*columns)
+    else:
+        statement = select(*columns).where(*key)
+    user_movie = db.session.execute(statement).first()
     
     # Commit the changes to the database
     db.session.commit()
     
+    if user_movie is None:
+        return jsonify({'message': 'User movie not found'}), 404
+    
+    # Apply the updated rating to the recommender
+    apply_committed([('rating', user_movie.userId, user_movie.movieId, user_movie.rating)])
+    
     # Serialize the new user_movie data using the user_movie schema
     result = usermovie_schema.dump(user_movie)
     
@@ -381,19 +603,21 @@ def predict_another():
         sample = data['genres']
     except KeyError:
         return jsonify({'error': 'No text sent'})
-    prediction = predict_new_user(sample)
-    recommendations = []
-    for index, row in prediction.iterrows():
-        recommendation = {
-            "movieId": row['movieId'],
-            "movieTitle": row['movieTitle'],
-            "movieGenre": row['movieGenre'],
-            "mean_rating": row['mean_rating'],
-            "movieImage": row['movieImage']
-        }
-        recommendations.append(recommendation)
-
-    return recommendations
+    rating_format = request.args.get('rating_format')
+    
+    # Serve from the cache, keyed on the sorted genre set
+    genres = normalize_genres(sample)
+    key = ('predict_new_user', genres, rating_format)
+    body = response_cache.get(key)
+    if body is None:
+        generation = response_cache.generation
+        prediction, degraded = recommend(predict_new_user, sample, fallback = lambda: best_rated_movies(10))
+        body = dumps(movie_records(prediction, rating_format))
+        if degraded is not None:
+            return degraded_response(body, degraded)
+        response_cache.set(key, body, [('genre', x) for x in genres], generation)
+
+    return json_response(body)
 
 # Predict user has rating
 @app.route('/predict', methods=['POST'])
@@ -403,58 +627,190 @@ def predict():
         sample = data['userId']
     except KeyError:
         return jsonify({'error': 'No text sent'})
-    prediction = predict_user_has_rating(sample)
-    
-    recommendations = []
-    for index, row in prediction.iterrows():
-        recommendation = {
-            "movieId": row['movieId'],
-            "movieTitle": row['movieTitle'],
-            "movieGenre": row['movieGenre'],
-            "mean_rating": row['mean_rating'],
-            "movieImage": row['movieImage']
-        }
-        recommendations.append(recommendation)
-
-    return recommendations
+    try:
+        top_n = int(data.get('top_n', 10))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_n must be an integer'}), 400
+    if top_n < 1:
+        return jsonify({'error': 'top_n must be at least 1'}), 400
+    top_n = min(top_n, MAX_RECOMMENDATIONS)
+    rating_format = request.args.get('rating_format')
+    
+    # Serve from the cache until the user or one of the recommended movies is rated
+    key = ('predict', sample, top_n, rating_format)
+    body = response_cache.get(key)
+    if body is None:
+        generation = response_cache.generation
+        prediction, degraded = recommend(predict_user_has_rating, sample, top_n = top_n, fallback = lambda: best_rated_movies(top_n))
+        body = dumps(movie_records(prediction, rating_format))
+        if degraded is not None:
+            return degraded_response(body, degraded)
+        tags = [('user', sample)] + [('movie', x) for x in prediction['movieId'].tolist()]
+        response_cache.set(key, body, tags, generation)
+
+    return json_response(body)
+
+# Predict many users has rating
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    data = request.get_json()
+    try:
+        samples = data['userIds']
+    except KeyError:
+        return jsonify({'error': 'No text sent'})
+    if not isinstance(samples, list) or not all(isinstance(x, int) and not isinstance(x, bool) for x in samples):
+        return jsonify({'error': 'userIds must be a list of integers'}), 400
+    if len(samples) > MAX_BATCH_USERS:
+        return jsonify({'error': f'userIds must have at most {MAX_BATCH_USERS} users'}), 400
+    try:
+        top_n = int(data.get('top_n', 10))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'top_n must be an integer'}), 400
+    if top_n < 1:
+        return jsonify({'error': 'top_n must be at least 1'}), 400
+    top_n = min(top_n, MAX_RECOMMENDATIONS)
+    rating_format = request.args.get('rating_format')
+    def popular():
+        movies = best_rated_movies(top_n)
+        return [(x, movies) for x in samples]
+    predictions, degraded = recommend(predict_users_batch, samples, top_n = top_n, fallback = popular)
+
+    results = [
+        {"userId": user_id, "movies": movie_records(prediction, rating_format)}
+        for user_id, prediction in predictions
+    ]
+    if degraded is not None:
+        return degraded_response(dumps(results), degraded)
+    return json_response(dumps(results))
 
 # MOVIE
 
 # Get all movies has rating
 @app.route('/movies', methods=['GET'])
 def get_all_movies():
-    data = get_all_movies_has_rating()
-    
-    movies_data = []
-    for index, row in data.iterrows():
-        movie_data = {
-            "movieId": row['movieId'],
-            "movieTitle": row['movieTitle'],
-            "movieGenre": row['movieGenre'],
-            "mean_rating": row['mean_rating'],
-            "movieImage": row['movieImage']
-        }
-        movies_data.append(movie_data)
+    rating_format = request.args.get('rating_format')
+    
+    # Any rating change can reorder the listing
+    key = ('movies', rating_format)
+    body = response_cache.get(key)
+    if body is None:
+        generation = response_cache.generation
+        data = get_all_movies_has_rating()
+        body = dumps(movie_records(data, rating_format))
+        response_cache.set(key, body, [('all',)], generation)
+
+    return json_response(body)
+
+# Add a movie to the catalog
+@app.route('/movies', methods=['POST'])
+def create_movie():
+    data = request.get_json()
+    new_movie = Movie(movieTitle = data['movieTitle'], movieGenre = data.get('movieGenre', ''), movieImage = data.get('movieImage', ''))
+    db.session.add(new_movie)
+    db.session.commit()
+
+    # Listed, searchable and recommendable without rebuilding the engines
+    add_catalog_movie(new_movie.movieId, new_movie.movieTitle, new_movie.movieGenre, new_movie.movieImage)
+    return jsonify(movie_schema.dump(new_movie)), 201
 
-    return movies_data
+# Search movies by title as the user types, not cached since nearly every query is new
+@app.route('/movies/search', methods=['GET'])
+def get_movies_search():
+    top_n = max(1, min(request.args.get('top_n', 10, type = int), MAX_SEARCH_RESULTS))
+    data = search_movies(request.args.get('q', ''), top_n = top_n)
+    return json_response(dumps(movie_records(data, request.args.get('rating_format'))))
 
 # Get movie by genre
 @app.route('/movies/<string:genre>', methods=['GET'])
 def get_movies_by_genre(genre):
-    data = get_movies_by_genre_utilities(genre)
-    
-    movies_data = []
-    for index, row in data.iterrows():
-        movie_data = {
-            "movieId": row['movieId'],
-            "movieTitle": row['movieTitle'],
-            "movieGenre": row['movieGenre'],
-            "mean_rating": row['mean_rating'],
-            "movieImage": row['movieImage']
-        }
-        movies_data.append(movie_data)
-
-    return movies_data
+    match_all = request.args.get('match') == 'all'
+    rating_format = request.args.get('rating_format')
+    
+    # Serve from the cache until a movie of one of the genres is rated
+    genres = normalize_genres(genre)
+    key = ('movies_genre', genres, match_all, rating_format)
+    body = response_cache.get(key)
+    if body is None:
+        generation = response_cache.generation
+        data = get_movies_by_genre_utilities(genre, match_all = match_all)
+        body = dumps(movie_records(data, rating_format))
+        response_cache.set(key, body, [('genre', x) for x in genres], generation)
+
+    return json_response(body)
+
+# Get movies similar to a movie
+@app.route('/movies/<int:movie_id>/similar', methods=['GET'])
+def get_movies_similar(movie_id):
+    top_n = request.args.get('top_n', 10, type = int)
+    data = get_similar_movies(movie_id, top_n = top_n)
+    if data is None:
+        return jsonify({'message': 'Movie not found'}), 404
+    
+    return json_response(dumps(movie_records(data, request.args.get('rating_format'))))
+
+# Switch to the published snapshot version without restarting
+@app.route('/snapshot/reload', methods=['POST'])
+def post_snapshot_reload():
+    version = reload_snapshot()
+    response_cache.clear()
+    return jsonify({'version': version, 'engines': registry.status()})
+
+# Online trainer progress
+@app.route('/trainer/stats', methods=['GET'])
+def get_trainer_stats():
+    return jsonify(registry.get('trainer').stats())
+
+# Change feed progress
+@app.route('/changes/stats', methods=['GET'])
+def get_changes_stats():
+    return jsonify(change_feed.stats())
+
+# Micro-batch sizes and queue waits of /predict
+@app.route('/batcher/stats', methods=['GET'])
+def get_batcher_stats():
+    if batcher is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **batcher.stats()})
+
+# Response cache counters
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    text = PrometheusText()
+    with metrics.lock:
+        requests = list(metrics.requests.items())
+    text.metric('http_requests_total', 'counter', 'Requests by endpoint, method and status.', [
+        ({'endpoint': endpoint, 'method': method, 'status': status}, count) for (endpoint, method, status), count in requests])
+    text.histogram('http_request_duration_seconds', 'Request latency by endpoint.', [
+        ({'endpoint': endpoint}, histogram.snapshot()) for endpoint, histogram in list(metrics.request_seconds.items())])
+    text.histogram('stage_duration_seconds', 'Time spent in each stage of the requests.', [
+        ({'stage': stage}, histogram.snapshot()) for stage, histogram in list(metrics.stages.items())])
+
+    cache_stats = response_cache.stats()
+    for name in ('hits', 'misses', 'evictions', 'invalidations'):
+        text.metric(f'response_cache_{name}_total', 'counter', f'Response cache {name}.', [({}, cache_stats[name])])
+    text.metric('response_cache_entries', 'gauge', 'Responses in the cache.', [({}, cache_stats['entries'])])
+
+    text.metric('process_resident_memory_bytes', 'gauge', 'Resident memory of the process.', [({}, resident_memory())])
+    text.metric('recommender_structure_bytes', 'gauge', 'Bytes of the in-memory recommender structures.', [
+        ({'structure': name}, size) for name, size in structure_sizes().items()])
+    text.metric('recommender_engine_build_seconds', 'gauge', 'Build time of each engine.', [
+        ({'engine': name}, status['seconds']) for name, status in registry.status().items() if 'seconds' in status])
+
+    if offload is not None:
+        offload_stats = offload.stats()
+        text.metric('recommender_pending', 'gauge', 'Recommender calls running or queued in the offload pool.', [({}, offload_stats['pending'])])
+        text.metric('recommender_degraded_total', 'counter', 'Recommender calls answered with the best rated movies.', [
+            ({'reason': reason}, count) for reason, count in offload_stats['degraded'].items()])
+
+    if batcher is not None:
+        text.histogram('batcher_batch_size', 'Predictions scored per batch.', [({}, batcher.batch_sizes.snapshot())])
+        text.histogram('batcher_queue_wait_seconds', 'Wait of each prediction before its batch is scored.', [({}, batcher.queue_waits.snapshot())])
+    return Response(text.render(), mimetype = 'text/plain; version=0.0.4')
 
 # Run server
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from metrics import Histogram
+
+# Upper bounds of the histogram buckets, the last bucket counts everything above
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+QUEUE_WAIT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+class MicroBatcher:
+    def __init__(self, score_batch, max_batch_size = 64, max_wait = 0.002):
+        # score_batch(items) returns one result per item, called from the worker thread only
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = queue.Queue()
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_waits = Histogram(QUEUE_WAIT_BUCKETS)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, item):
+        # Future of the result of item, scored together with the items submitted around the same time
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target = self.run, name = 'micro-batcher', daemon = True)
+                    self.thread.start()
+        future = Future()
+        self.queue.put((time.perf_counter(), item, future))
+        return future
+
+    def next_batch(self):
+        # Wait for a first item, then gather more until the batch is full or the window of the first one closes
+        batch = [self.queue.get()]
+        deadline = batch[0][0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout = timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            started = time.perf_counter()
+            self.batch_sizes.observe(len(batch))
+            for enqueued, _, _ in batch:
+                self.queue_waits.observe(started - enqueued)
+
+            try:
+                results = self.score_batch([item for _, item, _ in batch])
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait': self.max_wait,
+            'queued': self.queue.qsize(),
+            'batch_size': self.batch_sizes.snapshot(),
+            'queue_wait': self.queue_waits.snapshot(),
+        }
+
+if __name__ == "__main__":
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+
+    # Scoring throughput of 16 threads predicting one by one and through the batcher,
+    # on the served model or on argv[1] synthetic movies
+    if len(sys.argv) > 1:
+        from scorer import EmbeddingScorer
+        rng = np.random.default_rng(0)
+        num_movies = int(sys.argv[1])
+        scorer = EmbeddingScorer(
+            rng.normal(0, 0.1, (1000, 50)), rng.normal(0, 0.1, 1000),
+            rng.normal(0, 0.1, (num_movies, 50)), rng.normal(0, 0.1, num_movies))
+        requests = [(x, 10, np.zeros(num_movies, dtype = bool)) for x in range(1000)]
+        score_batch = lambda items: scorer.top_n_batch([x[0] for x in items], 10, exclude = np.stack([x[2] for x in items]))
+    else:
+        from utilities import registry, movies_not_recommendable, score_users_batch
+        scorer = registry.get('scorer')
+        user2user_encoded = registry.get('state').user2user_encoded
+        requests = [(user2user_encoded[x], 10, movies_not_recommendable(x, scorer)) for x in list(user2user_encoded)[:scorer.num_users]]
+        score_batch = score_users_batch
+
+    single = lambda request: scorer.top_n(request[0], request[1], exclude = request[2].copy())
+    batcher = MicroBatcher(score_batch)
+    batched = lambda request: batcher.submit(request).result()
+    print(f"{scorer.num_movies} movies")
+    for name, predict in [('one by one', single), ('batched', batched)]:
+        with ThreadPoolExecutor(16) as pool:
+            start = time.perf_counter()
+            list(pool.map(predict, requests))
+            seconds = time.perf_counter() - start
+        print(f"{name:>10}: {len(requests) / seconds:7.0f} users/s")
+
+    stats = batcher.stats()
+    print(f"mean batch size {stats['batch_size']['sum'] / stats['batch_size']['count']:.1f}, "
+          f"mean queue wait {stats['queue_wait']['sum'] / stats['queue_wait']['count'] * 1e3:.2f} ms")
@@ -0,0 +1,128 @@
+import csv
+import json
+import os
+import shutil
+import sys
+import time
+import click
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scorer import WEIGHT_NAMES, WEIGHTS_FILE
+from seed import seed
+from snapshot import publish
+
+GENRES = (
+    'Action', 'Adventure', 'Animation', 'Children', 'Comedy', 'Crime', 'Documentary', 'Drama', 'Fantasy', 'Film-Noir',
+    'Horror', 'IMAX', 'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western')
+
+def power_law(count, alpha, rng):
+    # Probability of each item in random order, the item of rank r drawn in proportion to r ** -alpha
+    weights = 1.0 / np.arange(1, count + 1) ** alpha
+    return rng.permutation(weights / weights.sum())
+
+def sample_pairs(num_ratings, user_weights, movie_weights, rng):
+    # Distinct (user, movie) pairs, drawn in rounds until enough are left after removing duplicates
+    num_movies = len(movie_weights)
+    keys = np.empty(0, dtype = np.int64)
+    while len(keys) < num_ratings:
+        draws = int((num_ratings - len(keys)) * 1.2) + 1000
+        users = rng.choice(len(user_weights), draws, p = user_weights)
+        movies = rng.choice(num_movies, draws, p = movie_weights)
+        keys = np.concatenate([keys, users.astype(np.int64) * num_movies + movies])
+        _, first = np.unique(keys, return_index = True)
+        keys = keys[np.sort(first)]
+    keys = keys[:num_ratings]
+    return keys // num_movies, keys % num_movies
+
+def generate(out, num_ratings, num_users, num_movies, alpha, dim, seed_value):
+    rng = np.random.default_rng(seed_value)
+    data = os.path.join(out, 'data')
+    os.makedirs(data, exist_ok = True)
+    os.makedirs(os.path.join(out, 'model'), exist_ok = True)
+
+    # Ratings of popular movies and active users follow the same power law
+    users, movies = sample_pairs(num_ratings, power_law(num_users, alpha, rng), power_law(num_movies, alpha, rng), rng)
+    quality = rng.normal(3.5, 0.5, num_movies)
+    leniency = rng.normal(0.0, 0.4, num_users)
+    ratings = np.clip(np.round((quality[movies] + leniency[users] + rng.normal(0.0, 0.8, num_ratings)) * 2) / 2, 0.5, 5.0)
+
+    # Same layout as data/users.json and data/movies.json, ratings as a MovieLens ratings.csv
+    with open(os.path.join(data, 'users.json'), 'w', encoding = 'utf-8') as json_file:
+        json.dump([{'userId': x} for x in range(1, num_users + 1)], json_file)
+    with open(os.path.join(data, 'movies.json'), 'w', encoding = 'utf-8') as json_file:
+        json.dump([{
+            'movieId': str(x),
+            'title': f'Movie {x} ({rng.integers(1950, 2024)})',
+            'genres': '|'.join(rng.choice(GENRES, rng.integers(1, 4), replace = False)),
+            'image': '',
+        } for x in range(1, num_movies + 1)], json_file)
+    with open(os.path.join(data, 'ratings.csv'), 'w', newline = '', encoding = 'utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['userId', 'movieId', 'rating'])
+        for start in range(0, num_ratings, 100000):
+            stop = start + 100000
+            writer.writerows(zip((users[start:stop] + 1).tolist(), (movies[start:stop] + 1).tolist(), ratings[start:stop].tolist()))
+
+    # Imported like a real dataset
+    db_path = os.path.join(out, 'db.sqlite')
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    seed(db_path, ['users', 'movies', 'ratings'], {
+        'users': os.path.join(data, 'users.json'),
+        'movies': os.path.join(data, 'movies.json'),
+        'ratings': os.path.join(data, 'ratings.csv'),
+    })
+
+    # Random RecommenderNet weights over the users and movies that have ratings, encoded in order of appearance
+    model_users, model_movies = len(np.unique(users)), len(np.unique(movies))
+    shapes = {
+        'user_embedding': (model_users, dim),
+        'user_bias': (model_users, 1),
+        'movie_embedding': (model_movies, dim),
+        'movie_bias': (model_movies, 1),
+    }
+    np.savez(os.path.join(out, 'model', WEIGHTS_FILE), **{
+        name: rng.normal(0.0, 0.1, shapes[name]).astype(np.float32) for name in WEIGHT_NAMES})
+    return model_users, model_movies
+
+def compile_dataset_snapshot(out):
+    # Served like production, otherwise every run rebuilds the engines from the ratings
+    os.environ.update(DB_PATH = os.path.join(out, 'db.sqlite'), MODEL_PATH = os.path.join(out, 'model'))
+    from utilities import compile_snapshot
+    root = os.path.join(out, 'snapshots')
+    version = compile_snapshot(root)
+    publish(root, version)
+    return version
+
+@click.command()
+@click.option('--out', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'), show_default = True, help = 'Dataset directory.')
+@click.option('--ratings', 'num_ratings', default = 100000, show_default = True, help = 'Ratings, 10k to 10M.')
+@click.option('--users', 'num_users', type = int, default = None, help = 'Users, ratings / 150 by default.')
+@click.option('--movies', 'num_movies', type = int, default = None, help = 'Movies, ratings / 10 by default.')
+@click.option('--alpha', default = 1.0, show_default = True, help = 'Power law exponent of movie popularity and user activity.')
+@click.option('--dim', default = 50, show_default = True, help = 'Embedding size of the random model.')
+@click.option('--seed', 'seed_value', default = 0, show_default = True, help = 'Random seed.')
+@click.option('--snapshot/--no-snapshot', 'with_snapshot', default = True, show_default = True, help = 'Compile and publish a snapshot of the dataset.')
+def generate_cli(out, num_ratings, num_users, num_movies, alpha, dim, seed_value, with_snapshot):
+    """Write a synthetic db.sqlite, data/*.json and model/ for the benchmarks."""
+    num_users = num_users or max(num_ratings // 150, 10)
+    num_movies = num_movies or max(num_ratings // 10, 100)
+    if num_ratings > num_users * num_movies // 2:
+        raise click.BadParameter('at most half of the user x movie pairs can be rated', param_hint = '--ratings')
+
+    start = time.perf_counter()
+    model_users, model_movies = generate(out, num_ratings, num_users, num_movies, alpha, dim, seed_value)
+    click.echo(f'{out}: {num_ratings} ratings of {model_users} users and {model_movies} movies in {time.perf_counter() - start:.1f}s')
+
+    snapshot_root = os.path.join(out, 'snapshots')
+    if os.path.exists(snapshot_root):
+        shutil.rmtree(snapshot_root)
+    if with_snapshot:
+        start = time.perf_counter()
+        version = compile_dataset_snapshot(out)
+        click.echo(f'snapshot {version} compiled in {time.perf_counter() - start:.1f}s')
+
+if __name__ == "__main__":
+    generate_cli()
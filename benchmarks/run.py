@@ -0,0 +1,159 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+import numpy as np
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Request of each scenario drawn from the dataset, users and movies picked by their number of ratings
+def predict_request(rng, dataset):
+    return 'POST', '/predict', {'userId': dataset.user(rng), 'top_n': 10}
+
+def predict_batch_request(rng, dataset):
+    return 'POST', '/predict/batch', {'userIds': [dataset.user(rng) for _ in range(32)], 'top_n': 10}
+
+def predict_new_user_request(rng, dataset):
+    return 'POST', '/predict_new_user', {'genres': ','.join(rng.choice(dataset.genres, rng.integers(1, 4), replace = False))}
+
+def movies_request(rng, dataset):
+    return 'GET', '/movies', None
+
+def movies_genre_request(rng, dataset):
+    return 'GET', f'/movies/{rng.choice(dataset.genres)}', None
+
+def similar_request(rng, dataset):
+    return 'GET', f'/movies/{dataset.movie(rng)}/similar', None
+
+def user_request(rng, dataset):
+    return 'GET', f'/users/{dataset.user(rng)}', None
+
+SCENARIOS = {
+    'predict': predict_request,
+    'predict_batch': predict_batch_request,
+    'predict_new_user': predict_new_user_request,
+    'movies': movies_request,
+    'movies_genre': movies_genre_request,
+    'similar': similar_request,
+    'user': user_request,
+}
+
+class Dataset:
+    def __init__(self, recommender_state, genres):
+        self.user_ids = np.array(list(recommender_state.user2user_encoded))
+        self.user_weights = np.array([len(recommender_state.ratings(x)) for x in self.user_ids.tolist()], dtype = np.float64)
+        self.user_weights /= self.user_weights.sum()
+        self.movie_ids = np.array(recommender_state.movie_stats.movie_ids)
+        self.movie_weights = np.asarray(recommender_state.movie_stats.ratings_count, dtype = np.float64)
+        self.movie_weights /= self.movie_weights.sum()
+        self.genres = genres
+
+    def user(self, rng):
+        return int(rng.choice(self.user_ids, p = self.user_weights))
+
+    def movie(self, rng):
+        return int(rng.choice(self.movie_ids, p = self.movie_weights))
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run_scenario(name, num_requests, threads, warmup, seed_value):
+    # Runs in its own process, so the peak RSS is the one of this endpoint only
+    sys.path.insert(0, basedir)
+    start = time.perf_counter()
+    import app as app_module
+    from utilities import registry
+    registry.warm(background = False)
+    startup = time.perf_counter() - start
+    startup_rss = peak_rss()
+
+    genres = sorted({x for value in registry.get('movies')['movieGenre'].dropna() for x in value.split('|')})
+    dataset = Dataset(registry.get('state'), genres)
+    rng = np.random.default_rng(seed_value)
+    requests = [SCENARIOS[name](rng, dataset) for _ in range(warmup + num_requests)]
+
+    clients = threading.local()
+    def send(request):
+        if not hasattr(clients, 'client'):
+            clients.client = app_module.app.test_client()
+        method, url, body = request
+        started = time.perf_counter()
+        response = clients.client.open(url, method = method, json = body)
+        response.get_data()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url}: {response.status_code}')
+        return time.perf_counter() - started
+
+    for request in requests[:warmup]:
+        send(request)
+    with ThreadPoolExecutor(threads) as pool:
+        start = time.perf_counter()
+        latencies = np.array(list(pool.map(send, requests[warmup:])))
+        seconds = time.perf_counter() - start
+
+    return {
+        'scenario': name,
+        'requests': num_requests,
+        'threads': threads,
+        'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+        'p99_ms': float(np.percentile(latencies, 99) * 1e3),
+        'throughput': num_requests / seconds,
+        'startup_s': startup,
+        'startup_rss_mb': startup_rss / 1e6,
+        'peak_rss_mb': peak_rss() / 1e6,
+        'engine_seconds': {engine: status.get('seconds') for engine, status in registry.status().items()},
+    }
+
+@click.command()
+@click.option('--data', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'), show_default = True, help = 'Dataset directory written by generate.py.')
+@click.option('--scenario', 'scenarios', multiple = True, type = click.Choice(list(SCENARIOS)), help = 'Scenarios to run, all by default.')
+@click.option('--requests', 'num_requests', default = 500, show_default = True, help = 'Timed requests per scenario.')
+@click.option('--threads', default = 1, show_default = True, help = 'Concurrent clients.')
+@click.option('--warmup', default = 20, show_default = True, help = 'Untimed requests before measuring.')
+@click.option('--seed', 'seed_value', default = 0, show_default = True, help = 'Random seed of the requests.')
+@click.option('--cache/--no-cache', default = False, show_default = True, help = 'Keep the response cache on.')
+@click.option('--output', type = click.Path(dir_okay = False), default = None, help = 'Also write the results as JSON.')
+@click.option('--worker', hidden = True, default = None)
+def run_cli(data, scenarios, num_requests, threads, warmup, seed_value, cache, output, worker):
+    """Load the endpoints with the Flask test client and report latency, throughput and peak RSS."""
+    if worker is not None:
+        click.echo(json.dumps(run_scenario(worker, num_requests, threads, warmup, seed_value)))
+        return
+
+    data = os.path.abspath(data)
+    env = dict(
+        os.environ,
+        DB_PATH = os.path.join(data, 'db.sqlite'),
+        MODEL_PATH = os.path.join(data, 'model'),
+        SNAPSHOT_PATH = os.path.join(data, 'snapshots'),
+        PRECOMPUTED_PATH = os.path.join(data, 'precomputed'),
+        WARM_ENGINES = '0',
+    )
+    env.pop('ONLINE_TRAINING', None)
+    if not cache:
+        env['RESPONSE_CACHE_SIZE'] = '0'
+
+    results = []
+    click.echo(f"{'scenario':<18}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>9}{'start s':>9}{'peak MB':>9}")
+    for name in scenarios or list(SCENARIOS):
+        output_lines = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', name, '--requests', str(num_requests),
+             '--threads', str(threads), '--warmup', str(warmup), '--seed', str(seed_value)],
+            env = env, cwd = data, check = True, stdout = subprocess.PIPE, text = True).stdout.splitlines()
+        result = json.loads(output_lines[-1])
+        results.append(result)
+        click.echo(f"{name:<18}{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}{result['throughput']:>9.0f}"
+                   f"{result['startup_s']:>9.2f}{result['peak_rss_mb']:>9.0f}")
+
+    if output:
+        with open(output, 'w', encoding = 'utf-8') as json_file:
+            json.dump(results, json_file, indent = 2)
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,114 @@
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import click
+import numpy as np
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def memory(pid):
+    # Rss, Pss (shared pages split between the processes mapping them) and private bytes of a process
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                values[parts[0].rstrip(':')] = int(parts[1]) * 1024
+    return {
+        'rss': values.get('Rss', 0),
+        'pss': values.get('Pss', 0),
+        'private': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as children_file:
+        return [int(x) for x in children_file.read().split()]
+
+def wait_ready(port, workers, master, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 5)
+            connection.request('GET', '/readyz')
+            if connection.getresponse().status == 200 and len(children(master)) >= workers:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise click.ClickException(f'server not ready after {timeout}s')
+
+def load(port, user_ids, clients, seconds, seed_value):
+    # Keep-alive clients posting /predict for random users until the time is up
+    counts = [0] * clients
+    stop = time.time() + seconds
+
+    def client(index):
+        rng = np.random.default_rng(seed_value + index)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout = 30)
+        while time.time() < stop:
+            body = json.dumps({'userId': int(rng.choice(user_ids)), 'top_n': 10})
+            connection.request('POST', '/predict', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                counts[index] += 1
+
+    threads = [threading.Thread(target = client, args = (x,)) for x in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+@click.command()
+@click.option('--data', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'), show_default = True, help = 'Dataset directory written by generate.py.')
+@click.option('--workers', 'worker_counts', default = '1,2,4', show_default = True, help = 'Comma separated worker counts.')
+@click.option('--preload/--no-preload', default = True, show_default = True, help = 'Build the engines in the master.')
+@click.option('--clients', default = 8, show_default = True, help = 'Concurrent keep-alive clients.')
+@click.option('--seconds', default = 10.0, show_default = True, help = 'Load duration per worker count.')
+@click.option('--port', default = 8765, show_default = True)
+@click.option('--seed', 'seed_value', default = 0, show_default = True, help = 'Random seed of the requests.')
+def serve_cli(data, worker_counts, preload, clients, seconds, port, seed_value):
+    """Start gunicorn on the dataset and report memory per worker and /predict throughput per worker count."""
+    import sqlite3
+    data = os.path.abspath(data)
+    connection = sqlite3.connect(os.path.join(data, 'db.sqlite'))
+    user_ids = np.array([x for x, in connection.execute('select distinct userId from user_movie')])
+    connection.close()
+
+    env = dict(
+        os.environ,
+        DB_PATH = os.path.join(data, 'db.sqlite'),
+        MODEL_PATH = os.path.join(data, 'model'),
+        SNAPSHOT_PATH = os.path.join(data, 'snapshots'),
+        PRECOMPUTED_PATH = os.path.join(data, 'precomputed'),
+        GUNICORN_PRELOAD = '1' if preload else '0',
+        RESPONSE_CACHE_SIZE = '0',
+        PORT = str(port),
+    )
+    click.echo(f"{'workers':>7}{'req/s':>9}{'rss MB':>9}{'pss MB':>9}{'private MB':>11}{'master pss MB':>14}{'total pss MB':>13}")
+    for workers in [int(x) for x in worker_counts.split(',')]:
+        env['WEB_CONCURRENCY'] = str(workers)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--config', os.path.join(basedir, 'gunicorn.conf.py'), '--log-level', 'warning', 'app:app'],
+            cwd = basedir, env = env)
+        try:
+            wait_ready(port, workers, server.pid, timeout = 600)
+            throughput = load(port, user_ids, clients, seconds, seed_value)
+            worker_memory = [memory(x) for x in children(server.pid)]
+            master_memory = memory(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+        mean = {key: np.mean([x[key] for x in worker_memory]) / 1e6 for key in ('rss', 'pss', 'private')}
+        total_pss = (master_memory['pss'] + sum(x['pss'] for x in worker_memory)) / 1e6
+        click.echo(f"{workers:>7}{throughput:>9.0f}{mean['rss']:>9.0f}{mean['pss']:>9.0f}{mean['private']:>11.0f}"
+                   f"{master_memory['pss'] / 1e6:>14.0f}{total_pss:>13.0f}")
+
+if __name__ == "__main__":
+    serve_cli()
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+
+class ResponseCache:
+    def __init__(self, max_entries = 4096, ttl = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # key -> (expires_at, value, tags), least recently used first
+        self.entries = OrderedDict()
+
+        # tag -> keys of the entries that depend on it
+        self.tag_keys = {}
+
+        # Bumped on every invalidation so results computed before it are not stored
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                    self.evictions += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, tags, generation = None):
+        with self.lock:
+            # Skip results that were computed before an invalidation
+            if generation is not None and generation != self.generation:
+                return
+
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self.tag_keys.setdefault(tag, set()).add(key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        # Drop every entry that depends on any of the tags
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self.tag_keys.pop(tag, ()):
+                    if key in self.entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tag_keys.clear()
+
+    def _remove(self, key):
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tag_keys[tag]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
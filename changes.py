@@ -0,0 +1,98 @@
+import threading
+import time
+
+# Every rating written, updated or deleted and every movie added is logged by triggers, whichever process or tool
+# wrote it. Each process applies the log to its own state from the last id it applied.
+# kind is 'rating' (rating set to the value), 'deleted' (rating removed) or 'movie' (catalog movie added)
+CHANGE_LOG = '''
+CREATE TABLE IF NOT EXISTS change_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    "userId" INTEGER,
+    "movieId" INTEGER NOT NULL,
+    rating FLOAT,
+    "changedAt" INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+CREATE INDEX IF NOT EXISTS ix_change_log_changedAt ON change_log ("changedAt");
+CREATE TRIGGER IF NOT EXISTS user_movie_inserted AFTER INSERT ON user_movie BEGIN
+    INSERT INTO change_log (kind, "userId", "movieId", rating) VALUES ('rating', NEW."userId", NEW."movieId", NEW.rating);
+END;
+CREATE TRIGGER IF NOT EXISTS user_movie_updated AFTER UPDATE OF "userId", "movieId", rating ON user_movie BEGIN
+    INSERT INTO change_log (kind, "userId", "movieId") SELECT 'deleted', OLD."userId", OLD."movieId"
+        WHERE OLD."userId" != NEW."userId" OR OLD."movieId" != NEW."movieId";
+    INSERT INTO change_log (kind, "userId", "movieId", rating) VALUES ('rating', NEW."userId", NEW."movieId", NEW.rating);
+END;
+CREATE TRIGGER IF NOT EXISTS user_movie_deleted AFTER DELETE ON user_movie BEGIN
+    INSERT INTO change_log (kind, "userId", "movieId") VALUES ('deleted', OLD."userId", OLD."movieId");
+END;
+CREATE TRIGGER IF NOT EXISTS movie_inserted AFTER INSERT ON movie BEGIN
+    INSERT INTO change_log (kind, "movieId") VALUES ('movie', NEW."movieId");
+END;
+'''
+
+class ChangeFeed:
+    # Seconds between two syncs, and between two deletions of the log rows older than retention seconds
+    interval = 1.0
+    prune_interval = 600.0
+    retention = 24 * 3600.0
+
+    def __init__(self, sync, prune):
+        # sync(on_change) brings the process up to date and returns the changes applied, None without a change log;
+        # prune(before) deletes the log rows changed before the unix time
+        self.sync = sync
+        self.prune = prune
+        self.on_change = None
+
+        self.changes_applied = 0
+        self.syncs = 0
+        self.last_error = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+        # Syncs of the feed thread and of the requests that wrote are applied one at a time, in log order
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, on_change = None):
+        # on_change is called with the cache tags of the applied changes, or None when every cached response may be stale
+        self.on_change = on_change
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.run, name = 'change-feed', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        next_prune = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + self.prune_interval
+                    self.prune(time.time() - self.retention)
+                self.last_error = None
+            except Exception as error:
+                self.last_error = error
+
+    def poll(self, on_change = None):
+        # Apply the pending changes now, returns their number or None without a change log
+        with self.lock:
+            applied = self.sync(on_change or self.on_change or (lambda tags: None))
+            self.syncs += 1
+            self.changes_applied += applied or 0
+            return applied
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'syncs': self.syncs,
+            'changes_applied': self.changes_applied,
+            'last_error': repr(self.last_error) if self.last_error is not None else None,
+        }
@@ -0,0 +1,55 @@
+import numpy as np
+
+# Shrinkage of the mean rating towards zero for movies with few ratings
+RATINGS_COUNT_PRIOR = 1000
+
+# Only movies rated above this are recommended to new users
+MIN_MEAN_RATING = 4.0
+
+class ColdStartEngine:
+    def __init__(self, genre_index):
+        self.genre_index = genre_index
+        self._genre_matrix = (None, None, None)
+
+    def genre_matrix(self):
+        # One-hot movie x genre matrix and row norms, rebuilt when the genre index grows
+        masks, genre_matrix, genre_norms = self._genre_matrix
+        if masks is not self.genre_index.masks:
+            masks = self.genre_index.masks
+            genre_matrix = np.ascontiguousarray(masks.T, dtype = np.float32)
+            genre_norms = np.linalg.norm(genre_matrix, axis = 1)
+            self._genre_matrix = (masks, genre_matrix, genre_norms)
+        return genre_matrix, genre_norms
+
+    def recommend(self, genres_list, movie_stats, top_n = 10):
+        genre_matrix, genre_norms = self.genre_matrix()
+        num_movies = min(len(genre_matrix), len(movie_stats.movie_ids))
+        genre_matrix = genre_matrix[:num_movies]
+
+        # Rated catalog movies that have any of the selected genres, from the genre index
+        genre_movies = (
+            self.genre_index.movies(genres_list)[:num_movies]
+            & movie_stats.in_catalog[:num_movies]
+            & (movie_stats.ratings_count[:num_movies] > 0))
+        num_genre_movies = np.count_nonzero(genre_movies)
+        if num_genre_movies == 0:
+            return np.empty(0, dtype = np.int64)
+
+        # Mean genre vector of those movies as a single matrix-vector product
+        genre_vector = (genre_movies.astype(np.float32) @ genre_matrix) / num_genre_movies
+
+        # Only well rated movies are recommended, so only they need a score
+        candidates = np.flatnonzero(genre_movies & (movie_stats.mean[:num_movies] > MIN_MEAN_RATING))
+
+        # Cosine similarity between the genre vector and each candidate, one row per movie
+        similarity_scores = (genre_matrix[candidates] @ genre_vector) / (
+            genre_norms[candidates] * np.linalg.norm(genre_vector))
+
+        # Weighted average rating of each candidate
+        mean_rating = movie_stats.mean[candidates]
+        ratings_count = movie_stats.ratings_count[candidates]
+        weighted_rating = mean_rating * ratings_count / (ratings_count + RATINGS_COUNT_PRIOR)
+
+        # Sort by similarity, then weighted rating
+        order = np.lexsort((-weighted_rating, -similarity_scores))
+        return candidates[order[:top_n]]
@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Seconds `import app` may take, the heavy work happens on first use or in the background
+IMPORT_TIME_BUDGET = 2.0
+
+class EngineRegistry:
+    def __init__(self):
+        # name -> function building the engine, called once on first use
+        self.builders = {}
+        self.locks = {}
+
+        self.engines = {}
+        self.errors = {}
+        self.build_seconds = {}
+
+    def register(self, name):
+        # Decorator registering the builder of an engine
+        def decorator(builder):
+            self.builders[name] = builder
+            self.locks[name] = threading.Lock()
+            return builder
+        return decorator
+
+    def get(self, name):
+        # Built engine, building it first if needed; builders get the engines they depend on from the registry passed in
+        engines = self.engines
+        if name in engines:
+            return engines[name]
+
+        # A build that finishes after a swap only lands in the engines it started from
+        with self.locks[name]:
+            if name not in engines:
+                start = time.perf_counter()
+                try:
+                    engine = self.builders[name](self)
+                except Exception as error:
+                    self.errors[name] = error
+                    raise
+                self.build_seconds[name] = time.perf_counter() - start
+                self.errors.pop(name, None)
+                engines[name] = engine
+            return engines[name]
+
+    def peek(self, name):
+        # Built engine or None, never builds
+        return self.engines.get(name)
+
+    def publish(self, name, engine):
+        # Replace a built engine, requests pick it up on their next lookup
+        self.engines[name] = engine
+
+    def copy(self, builders = None):
+        # Registry with the same builders (some replaced), nothing built yet
+        staged = EngineRegistry()
+        for name, builder in {**self.builders, **(builders or {})}.items():
+            staged.register(name)(builder)
+        return staged
+
+    def swap(self, staged):
+        # Build every engine of staged, then publish them all at once; in flight requests keep the old ones
+        for name in staged.builders:
+            staged.get(name)
+        self.engines = staged.engines
+        self.build_seconds = staged.build_seconds
+        self.errors = {}
+
+    def ready(self, names = None):
+        return all(name in self.engines for name in names or self.builders)
+
+    def warm(self, names = None, background = True):
+        # Build the engines one after another, failures are kept in errors and retried on next use
+        def build_all():
+            for name in names or list(self.builders):
+                try:
+                    self.get(name)
+                except Exception:
+                    pass
+
+        if not background:
+            build_all()
+            return None
+        thread = threading.Thread(target = build_all, name = 'engine-warmup', daemon = True)
+        thread.start()
+        return thread
+
+    def status(self):
+        result = {}
+        for name in self.builders:
+            if name in self.engines:
+                result[name] = {'state': 'ready', 'seconds': round(self.build_seconds[name], 3)}
+            elif self.locks[name].locked():
+                result[name] = {'state': 'building'}
+            elif name in self.errors:
+                result[name] = {'state': 'failed', 'error': repr(self.errors[name])}
+            else:
+                result[name] = {'state': 'pending'}
+        return result
+
+if __name__ == "__main__":
+    # Measure `import app` in a fresh interpreter without warming, then the build time of every engine
+    command = 'import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)'
+    env = dict(os.environ, WARM_ENGINES = '0')
+    seconds = float(subprocess.run([sys.executable, '-c', command], env = env, capture_output = True, text = True, check = True).stdout)
+    print(f"import app: {seconds:.3f}s (budget {IMPORT_TIME_BUDGET:.1f}s)")
+
+    from utilities import registry
+    for name in registry.builders:
+        registry.get(name)
+        print(f"{name:>12}: {registry.build_seconds[name]:.3f}s")
+
+    sys.exit(0 if seconds <= IMPORT_TIME_BUDGET else 1)
@@ -0,0 +1,60 @@
+import threading
+import numpy as np
+
+# The model was trained on ratings normalized to 0-1 over this range, predicted through a sigmoid
+MIN_RATING = 0.5
+MAX_RATING = 5.0
+
+# Ridge penalty on the folded in vector, keeps users with few ratings close to the average user
+REGULARIZATION = 1.0
+
+def fold_in(movie_embedding, movie_bias, ratings, regularization = REGULARIZATION, bias_regularization = 1e-6):
+    # Least squares user vector and bias so that movie . user + movie_bias + user_bias matches the logit of each rating
+    normalized = np.clip((np.asarray(ratings, dtype = np.float64) - MIN_RATING) / (MAX_RATING - MIN_RATING), 0.01, 0.99)
+    targets = np.log(normalized / (1.0 - normalized)) - movie_bias
+
+    # The bias is the last unknown and is barely penalized unless asked
+    features = np.hstack([movie_embedding, np.ones((len(targets), 1))]).astype(np.float64)
+    penalty = np.full(features.shape[1], regularization)
+    penalty[-1] = bias_regularization
+    solution = np.linalg.solve(features.T @ features + np.diag(penalty), features.T @ targets)
+    return solution[:-1].astype(np.float32), float(solution[-1])
+
+class FoldInCache:
+    def __init__(self, recommender_state):
+        self.recommender_state = recommender_state
+
+        # userId -> (user vector, user bias), dropped when the user's ratings change
+        self.vectors = {}
+
+        # Bumped on every invalidation so vectors computed before it are not stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id, scorer):
+        # Vector and bias of the user from the movies it rated that the model knows, None without any
+        entry = self.vectors.get(user_id)
+        if entry is not None:
+            return entry
+
+        generation = self.generation
+        movie2movie_encoded = self.recommender_state.movie2movie_encoded
+        with self.recommender_state.lock:
+            ratings = dict(self.recommender_state.ratings(user_id))
+        movies_encoded = np.array([movie2movie_encoded[x] for x in ratings], dtype = np.int64)
+        known = movies_encoded < scorer.num_movies
+        if not known.any():
+            return None
+
+        movies_encoded = movies_encoded[known]
+        entry = fold_in(scorer.movie_vectors(movies_encoded), scorer.movie_bias[movies_encoded],
+                        np.fromiter(ratings.values(), dtype = np.float64)[known])
+        with self.lock:
+            if generation == self.generation:
+                self.vectors[user_id] = entry
+        return entry
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generation += 1
+            self.vectors.pop(user_id, None)
@@ -0,0 +1,82 @@
+import numpy as np
+
+class GenreIndex:
+    def __init__(self, genre_names, masks):
+        # Genre x movie bitsets, one row per genre aligned by encoded movie index
+        self.genre_names = list(genre_names)
+        self.genre_rows = {name.lower() : j for j, name in enumerate(self.genre_names)}
+        self.masks = np.ascontiguousarray(masks, dtype = bool)
+
+        # masks is a view of the first columns of buffer, whose columns double when full so adding a movie does not copy it
+        self.buffer = self.masks
+
+        # Bitsets reordered by movie rating, rebuilt when the rating order changes
+        self._ranked = (None, None)
+
+    @classmethod
+    def from_genres(cls, movie_genres):
+        # movie_genres holds the pipe separated movieGenre of each encoded movie
+        movie_genres = [x.split('|') if x else [] for x in movie_genres]
+        genre_names = sorted({genre for genres in movie_genres for genre in genres})
+        genre_rows = {name : j for j, name in enumerate(genre_names)}
+
+        masks = np.zeros((len(genre_names), len(movie_genres)), dtype = bool)
+        for i, genres in enumerate(movie_genres):
+            masks[[genre_rows[genre] for genre in genres], i] = True
+
+        return cls(genre_names, masks)
+
+    @property
+    def num_movies(self):
+        return self.masks.shape[1]
+
+    def add_movie(self, movie_genre):
+        # Set the bitset column of a newly encoded movie, past the columns readers see
+        index = self.num_movies
+        buffer = self.buffer
+        if index == buffer.shape[1]:
+            buffer = np.hstack([buffer, np.zeros((buffer.shape[0], max(index, 16)), dtype = bool)])
+
+        # A new genre gets a row, it can be looked up once the masks have it
+        genres = {x.lower() : x for x in movie_genre.split('|')} if movie_genre else {}
+        new_rows = {x : len(self.genre_names) + j for j, x in enumerate(x for x in genres if x not in self.genre_rows)}
+        if new_rows:
+            buffer = np.vstack([buffer, np.zeros((len(new_rows), buffer.shape[1]), dtype = bool)])
+        buffer[[new_rows[x] if x in new_rows else self.genre_rows[x] for x in genres], index] = True
+
+        self.buffer = buffer
+        self.masks = buffer[:, :index + 1]
+        for genre, row in new_rows.items():
+            self.genre_rows[genre] = row
+            self.genre_names.append(genres[genre])
+        self._ranked = (None, None)
+
+    def resolve(self, genres):
+        # Rows of the known genres, matched case insensitively
+        rows = [self.genre_rows.get(x.strip().lower()) for x in genres]
+        return [x for x in rows if x is not None]
+
+    def _combine(self, masks, rows, match_all):
+        if match_all:
+            return np.logical_and.reduce(masks[rows], axis = 0)
+        return np.logical_or.reduce(masks[rows], axis = 0)
+
+    def movies(self, genres, match_all = False):
+        # Bitset of the movies having any (or all) of the genres
+        rows = self.resolve(genres)
+        if not rows or (match_all and len(rows) < len(genres)):
+            return np.zeros(self.num_movies, dtype = bool)
+        return self._combine(self.masks, rows, match_all)
+
+    def ranked(self, genres, order, match_all = False):
+        # Movies having the genres, already sorted like order (encoded indices sorted by rating)
+        rows = self.resolve(genres)
+        if not rows or (match_all and len(rows) < len(genres)):
+            return order[:0]
+
+        ranked_order, ranked_masks = self._ranked
+        if ranked_order is not order:
+            ranked_masks = np.ascontiguousarray(self.masks[:, order])
+            self._ranked = (order, ranked_masks)
+
+        return order[self._combine(ranked_masks, rows, match_all)]
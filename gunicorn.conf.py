@@ -0,0 +1,49 @@
+import gc
+import multiprocessing
+import os
+
+# gunicorn --config gunicorn.conf.py app:app
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+# Each worker applies the writes of the others and the published versions through its change feed
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# Import the app and build the engines once in the master, workers get them copy-on-write when forked
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# No background threads in the master: the engines are built before forking, the change feed and the trainer run per worker
+warm_engines = os.environ.get('WARM_ENGINES', '1') == '1'
+online_training = os.environ.pop('ONLINE_TRAINING', None) == '1'
+follow_changes = os.environ.get('CHANGE_FEED', '1') == '1'
+os.environ['CHANGE_FEED'] = '0'
+if preload_app:
+    os.environ['WARM_ENGINES'] = '0'
+
+    # Objects allocated while loading are never collected, so the collector does not write to their pages
+    gc.disable()
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from utilities import registry
+    if warm_engines:
+        registry.warm(background = False)
+        server.log.info('engines built in the master: %s', ', '.join(f"{name} {status['state']}" for name, status in registry.status().items()))
+    gc.collect()
+    gc.freeze()
+
+def post_fork(server, worker):
+    from app import app, db, change_feed, invalidate_changes, invalidate_trained, start_online_training
+    gc.enable()
+
+    # SQLite connections opened in the master must not be shared with the workers
+    with app.app_context():
+        db.engine.dispose(close = False)
+
+    if follow_changes:
+        change_feed.start(on_change = invalidate_changes)
+    if online_training:
+        start_online_training(on_publish = invalidate_trained)
@@ -0,0 +1,167 @@
+import bisect
+import collections
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histograms, the last bucket counts everything above
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        # Cumulative counts per upper bound, like a Prometheus histogram
+        with self.lock:
+            cumulative, total = {}, 0
+            for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+                total += count
+                cumulative[str(bound)] = total
+            return {'buckets': cumulative, 'count': self.count, 'sum': self.sum}
+
+class Metrics:
+    def __init__(self):
+        # stage -> latency histogram of the spans, (endpoint, method, status) -> requests, endpoint -> latency histogram
+        self.stages = {}
+        self.requests = collections.Counter()
+        self.request_seconds = {}
+        self.lock = threading.Lock()
+
+        # Spans of the request being handled by each thread, for its Server-Timing header
+        self.local = threading.local()
+
+    def histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = histograms.setdefault(key, Histogram(LATENCY_BUCKETS))
+        return histogram
+
+    def observe_stage(self, stage, seconds):
+        self.histogram(self.stages, stage).observe(seconds)
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def start_request(self):
+        self.local.timings = {}
+
+    def merge_timings(self, timings):
+        # Stages timed in another thread on behalf of this thread's request
+        current = getattr(self.local, 'timings', None)
+        if current is not None:
+            for stage, seconds in timings.items():
+                current[stage] = current.get(stage, 0.0) + seconds
+
+    def end_request(self, endpoint, method, status, seconds):
+        # Stage seconds of the request that just ended
+        with self.lock:
+            self.requests[(endpoint, method, status)] += 1
+        self.histogram(self.request_seconds, endpoint).observe(seconds)
+        timings, self.local.timings = getattr(self.local, 'timings', None) or {}, None
+        return timings
+
+def server_timing(timings):
+    # Server-Timing header value, durations in milliseconds
+    return ', '.join(f'{stage};dur={seconds * 1e3:.3f}' for stage, seconds in timings.items())
+
+def resident_memory():
+    # Current RSS from /proc, the peak RSS where there is no /proc
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels.items()) + '}'
+
+class PrometheusText:
+    # Prometheus text exposition format, one HELP and TYPE line per metric name
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name, value, labels = None):
+        self.lines.append(f'{name}{label_string(labels)} {float(value)!r}')
+
+    def metric(self, name, kind, help_text, samples):
+        # samples is a list of (labels, value)
+        self.header(name, kind, help_text)
+        for labels, value in samples:
+            self.sample(name, value, labels)
+
+    def histogram(self, name, help_text, histograms):
+        # histograms is a list of (labels, Histogram.snapshot())
+        self.header(name, 'histogram', help_text)
+        for labels, snapshot in histograms:
+            for bound, count in snapshot['buckets'].items():
+                self.sample(f'{name}_bucket', count, {**labels, 'le': bound})
+            self.sample(f'{name}_sum', snapshot['sum'], labels)
+            self.sample(f'{name}_count', snapshot['count'], labels)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+class SamplingProfiler:
+    # Samples the stack of one thread every interval seconds and counts the folded stacks,
+    # the output feeds flamegraph.pl or speedscope
+    def __init__(self, thread_id, interval = 0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = 'sampling-profiler', daemon = True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+# Spans of every module go to the same registry
+metrics = Metrics()
+span = metrics.span
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Per movie arrays, aligned by encoded movie index
+COLUMNS = {
+    'movie_ids': np.int64, 'ratings_sum': np.float64, 'ratings_count': np.int64,
+    'in_catalog': bool, 'mean': np.float64, 'weighted': np.float64}
+
+class MovieStats:
+    def __init__(self, movie_ids, ratings_sum, ratings_count, in_catalog, min_votes = None):
+        # Each column is a view of the first num_movies rows of a buffer that doubles when full,
+        # so appending a movie does not copy every array
+        self.num_movies = len(movie_ids)
+        self.buffers = {name : np.zeros(self.num_movies, dtype = dtype) for name, dtype in COLUMNS.items()}
+        self.buffers['movie_ids'][:] = movie_ids
+        self.buffers['ratings_sum'][:] = ratings_sum
+        self.buffers['ratings_count'][:] = ratings_count
+        self.buffers['in_catalog'][:] = in_catalog
+        self._views()
+
+        # Number of ratings a movie needs before its own mean dominates the weighted rating
+        if min_votes is None:
+            min_votes = float(np.median(self.ratings_count)) if len(self.ratings_count) else 0.0
+        self.min_votes = min_votes
+
+        self.refresh()
+
+        # Order of the last listing, kept after rating changes for answers that must not wait on a sort
+        self.last_ranked = self.ranked()
+
+    @classmethod
+    def from_ratings(cls, ratings_df, movie2movie_encoded, catalog_movie_ids, min_votes = None):
+        movie_ids = np.array(list(movie2movie_encoded.keys()), dtype = np.int64)
+        encoded = ratings_df['movieId'].map(movie2movie_encoded).values
+
+        # Sum and count of the ratings of each movie in one pass
+        ratings_sum = np.bincount(encoded, weights = ratings_df['rating'].values, minlength = len(movie_ids))
+        ratings_count = np.bincount(encoded, minlength = len(movie_ids))
+        in_catalog = np.isin(movie_ids, np.fromiter(catalog_movie_ids, dtype = np.int64))
+
+        return cls(movie_ids, ratings_sum, ratings_count, in_catalog, min_votes = min_votes)
+
+    def _views(self):
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer[:self.num_movies])
+
+    def refresh(self):
+        # Mean and Bayesian weighted rating of every movie
+        count = self.ratings_count
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            self.mean[:] = np.where(count > 0, self.ratings_sum / count, 0.0)
+        self.total_sum = self.ratings_sum.sum()
+        self.total_count = count.sum()
+        self.global_mean = self.total_sum / self.total_count if self.total_count else 0.0
+        self.weighted[:] = (count * self.mean + self.min_votes * self.global_mean) / np.maximum(count + self.min_votes, 1)
+        self._ranked = None
+
+    def update(self, index, delta_sum, delta_count):
+        # Apply a rating change to one movie without touching the others
+        self.ratings_sum[index] += delta_sum
+        self.ratings_count[index] += delta_count
+        self.total_sum += delta_sum
+        self.total_count += delta_count
+        if self.total_count:
+            self.global_mean = self.total_sum / self.total_count
+
+        count = self.ratings_count[index]
+        self.mean[index] = self.ratings_sum[index] / count if count > 0 else 0.0
+        self.weighted[index] = (count * self.mean[index] + self.min_votes * self.global_mean) / max(count + self.min_votes, 1)
+
+        # The rating order is sorted again on the next listing
+        self._ranked = None
+
+    def add_movie(self, movie_id, in_catalog):
+        # Append a movie that had no ratings so far, its row is written before the views grow to include it
+        index = self.num_movies
+        if index == len(self.buffers['movie_ids']):
+            self.buffers = {
+                name : np.concatenate([buffer, np.zeros(max(index, 16), dtype = buffer.dtype)]) for name, buffer in self.buffers.items()}
+        row = {'movie_ids': movie_id, 'ratings_sum': 0.0, 'ratings_count': 0, 'in_catalog': in_catalog, 'mean': 0.0, 'weighted': self.global_mean}
+        for name, value in row.items():
+            self.buffers[name][index] = value
+        self.num_movies += 1
+        self._views()
+        self._ranked = None
+
+    def set_in_catalog(self, index, in_catalog):
+        # A rated movie was added to the catalog (or removed from it)
+        self.in_catalog[index] = in_catalog
+        self._ranked = None
+
+    def ranked(self):
+        # Rated catalog movies by mean rating, ties broken by number of ratings
+        if self._ranked is None:
+            order = np.lexsort((-self.ratings_count, -self.mean))
+            self._ranked = self.last_ranked = order[self.in_catalog[order] & (self.ratings_count[order] > 0)]
+        return self._ranked
+
+def format_rating(values):
+    # Format ratings with one decimal without a per-row lambda
+    return np.char.mod('%.1f', np.asarray(values, dtype = np.float64))
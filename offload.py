@@ -0,0 +1,67 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from metrics import metrics
+
+class Offload:
+    def __init__(self, max_workers = 2, max_queued = 16, deadline = 1.0):
+        # At most max_workers recommender calls run at once and max_queued more wait, the rest are turned away
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix = 'recommender')
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.deadline = deadline
+        self.slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+        # reason -> calls answered with the fallback
+        self.degraded = collections.Counter()
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def release(self, _):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def run(self, fn, *args, fallback, **kwargs):
+        # (result of fn, None), or (result of fallback, reason) when the pool is full or fn misses the deadline
+        if not self.slots.acquire(blocking = False):
+            return self.degrade('overloaded', fallback)
+        with self.lock:
+            self.pending += 1
+
+        # Stages timed in the pool thread are added to the request's own
+        enqueued = time.perf_counter()
+        def task():
+            metrics.start_request()
+            metrics.observe_stage('queue', time.perf_counter() - enqueued)
+            try:
+                return fn(*args, **kwargs), metrics.local.timings
+            finally:
+                metrics.local.timings = None
+
+        future = self.executor.submit(task)
+        future.add_done_callback(self.release)
+        try:
+            result, timings = future.result(timeout = self.deadline)
+        except TimeoutError:
+            # A call still queued is dropped, a running one finishes in the background and keeps its slot
+            future.cancel()
+            return self.degrade('deadline', fallback)
+        metrics.merge_timings(timings)
+        return result, None
+
+    def degrade(self, reason, fallback):
+        with self.lock:
+            self.degraded[reason] += 1
+        return fallback(), reason
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+                'deadline': self.deadline,
+                'pending': self.pending,
+                'degraded': dict(self.degraded),
+            }
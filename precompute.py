@@ -0,0 +1,153 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import click
+import numpy as np
+from snapshot import Snapshot, write_snapshot, publish
+from state import ratings_csr
+
+# Set in the parent before the pool forks, so workers share them instead of receiving copies
+_job = {}
+
+def score_block(start, stop):
+    # Top movies of the encoded users start:stop, -1 padded, watched and non catalog movies excluded
+    scorer, top_n = _job['scorer'], _job['top_n']
+    indptr, rating_movies = _job['rating_indptr'], _job['rating_movies']
+    num_movies = scorer.num_movies
+
+    exclude = np.tile(_job['not_in_catalog'], (stop - start, 1))
+    rows = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+    movies = rating_movies[indptr[start]:indptr[stop]]
+    known = movies < num_movies
+    exclude[rows[known], movies[known]] = True
+
+    result = np.full((stop - start, top_n), -1, dtype = np.int32)
+    for row, indices in enumerate(scorer.top_n_batch(np.arange(start, stop), top_n, exclude = exclude)):
+        result[row, :len(indices)] = indices
+    return start, result
+
+def precompute(scorer, recommender_state, top_n = 50, block_size = 1024, processes = None):
+    # Encoded users known to the model, scored block by block across a process pool
+    num_users = min(len(recommender_state.user2user_encoded), scorer.num_users)
+    users_encoded, movies_encoded, _ = recommender_state.ratings_arrays()
+    rating_indptr, rating_movies, _ = ratings_csr(users_encoded, movies_encoded, np.zeros(len(users_encoded)), len(recommender_state.user2user_encoded))
+
+    _job.update(
+        scorer = scorer, top_n = top_n, rating_indptr = rating_indptr, rating_movies = rating_movies,
+        not_in_catalog = ~recommender_state.movie_stats.in_catalog[:scorer.num_movies])
+    movies = np.full((num_users, top_n), -1, dtype = np.int32)
+    blocks = [(start, min(start + block_size, num_users)) for start in range(0, num_users, block_size)]
+    try:
+        if processes == 1 or len(blocks) <= 1:
+            results = [score_block(start, stop) for start, stop in blocks]
+        else:
+            with ProcessPoolExecutor(processes, mp_context = multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(score_block, *zip(*blocks)))
+    finally:
+        _job.clear()
+    for start, result in results:
+        movies[start:start + len(result)] = result
+
+    user_ids = np.array([recommender_state.user_encoded2user[i] for i in range(num_users)], dtype = np.int64)
+    return user_ids, movies
+
+class PrecomputedRecommendations:
+    def __init__(self, user_ids, movies, movie_ids, created, top_n, version = None):
+        # Row i holds the encoded top movies of the user user_ids[i], -1 padded
+        self.user_ids = user_ids
+        self.movies = movies
+        self.movie_ids = movie_ids
+        self.created = created
+        self.top_n = top_n
+        self.version = version
+
+    @classmethod
+    def load(cls, root):
+        snapshot = Snapshot.load(root)
+        if snapshot is None:
+            return None
+        return cls(
+            snapshot['user_ids'], snapshot['movies'], snapshot['movie_ids'], snapshot.manifest['created'], snapshot.manifest['top_n'],
+            snapshot.version)
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+    def matches(self, movie_ids):
+        # The movie encoding used when computing must be a prefix of the served one
+        return len(self.movie_ids) <= len(movie_ids) and np.array_equal(self.movie_ids, movie_ids[:len(self.movie_ids)])
+
+    def get(self, user_id, user_encoded):
+        # Every stored top movie of the user, encoded and in order, None when the user is missing
+        if user_encoded >= len(self.user_ids) or self.user_ids[user_encoded] != user_id:
+            return None
+        movies = self.movies[user_encoded]
+        return movies[movies >= 0]
+
+@click.command('precompute')
+@click.option('--top-n', default = 50, show_default = True, help = 'Movies stored per user.')
+@click.option('--block-size', default = 1024, show_default = True, help = 'Users per matrix product.')
+@click.option('--processes', type = int, default = None, help = 'Worker processes, CPU count by default.')
+@click.option('--publish/--no-publish', 'publish_version', default = True, show_default = True, help = 'Serve the new version.')
+def precompute_cli(top_n, block_size, processes, publish_version):
+    """Compute the top movies of every user for /predict."""
+    from utilities import registry, path_precomputed
+    scorer = registry.get('scorer')
+    recommender_state = registry.get('state')
+
+    start = time.perf_counter()
+    user_ids, movies = precompute(scorer, recommender_state, top_n = top_n, block_size = block_size, processes = processes)
+    seconds = time.perf_counter() - start
+    click.echo(f'{len(user_ids)} users in {seconds:.2f}s ({len(user_ids) / max(seconds, 1e-9):.0f} users/s)')
+
+    version = write_snapshot(path_precomputed, {
+        'user_ids': user_ids,
+        'movies': movies,
+        'movie_ids': recommender_state.movie_stats.movie_ids[:scorer.num_movies],
+    }, {'top_n': top_n})
+    click.echo(f'{version}: {movies.nbytes / 1e6:.1f} MB')
+    if publish_version:
+        publish(path_precomputed, version)
+        click.echo(f'{version} published')
+
+if __name__ == "__main__":
+    import os
+    import shutil
+    import sqlite3
+    import sys
+    import tempfile
+
+    # Regression check on a copy of the database: a movie rated before a restart is not served from the precomputed table
+    root = tempfile.mkdtemp()
+    try:
+        source, copy = sqlite3.connect(os.environ.get('DB_PATH', 'db.sqlite')), sqlite3.connect(os.path.join(root, 'db.sqlite'))
+        source.backup(copy)
+        source.close()
+        os.environ.update(
+            DB_PATH = os.path.join(root, 'db.sqlite'), SNAPSHOT_PATH = os.path.join(root, 'snapshots'),
+            PRECOMPUTED_PATH = os.path.join(root, 'precomputed'), WARM_ENGINES = '0')
+        from utilities import registry, path_precomputed, predict_user_has_rating
+
+        scorer, recommender_state = registry.get('scorer'), registry.get('state')
+        user_ids, movies = precompute(scorer, recommender_state, processes = 1)
+        publish(path_precomputed, write_snapshot(path_precomputed, {
+            'user_ids': user_ids,
+            'movies': movies,
+            'movie_ids': recommender_state.movie_stats.movie_ids[:scorer.num_movies],
+        }, {'top_n': 50}))
+        user_id, first_pick = int(user_ids[0]), int(recommender_state.movie_stats.movie_ids[movies[0, 0]])
+        copy.execute('insert into user_movie (userId, movieId, rating, isFavorited, isWatched) values (?, ?, 5.0, 0, 1)', (user_id, first_pick))
+        copy.commit()
+        copy.close()
+
+        # A restart builds the engines again, the rating is read from the database and the user has no in-memory changes
+        registry.swap(registry.copy())
+        served = predict_user_has_rating(user_id)['movieId'].tolist()
+        from_table = registry.get('precomputed') is not None and served == [
+            int(x) for x in recommender_state.movie_stats.movie_ids[movies[0, 1:11]]]
+    finally:
+        shutil.rmtree(root)
+
+    print(f"user {user_id} rated {first_pick} before the restart, served {served[:3]}... from the precomputed table: {from_table}")
+    sys.exit(0 if first_pick not in served and from_table else 1)
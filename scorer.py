@@ -0,0 +1,272 @@
+import os
+import numpy as np
+
+# Weights of the RecommenderNet layers used for scoring
+WEIGHT_NAMES = ('user_embedding', 'user_bias', 'movie_embedding', 'movie_bias')
+
+# Weights exported next to the saved model so serving does not need TensorFlow
+WEIGHTS_FILE = 'embeddings.npz'
+
+def load_embedding_weights(path_model):
+    path_weights = os.path.join(path_model, WEIGHTS_FILE)
+
+    # Read the exported weights if they exist
+    if os.path.exists(path_weights):
+        with np.load(path_weights) as data:
+            return {name: data[name] for name in WEIGHT_NAMES}
+
+    # Otherwise load the saved RecommenderNet once and pull the weights out of it
+    import tensorflow as tf
+    model_keras = tf.keras.models.load_model(path_model)
+    weights = {name: getattr(model_keras, name).get_weights()[0] for name in WEIGHT_NAMES}
+
+    # Export the weights for the next start, the model folder may be read only
+    try:
+        np.savez(path_weights, **weights)
+    except OSError:
+        pass
+
+    return weights
+
+def keras_logits(scorer, user_encoded, movies, batch_size = 32):
+    # What model.predict returned before the sigmoid, for the user against the encoded movies: RecommenderNet's
+    # tf.tensordot(user_vector, movie_vector, 2) sums the dot products over each predict batch, so every movie
+    # of a batch gets the same dot term and only the movie bias orders them. The scorer ranks on each movie's own
+    # dot product instead, the score RecommenderNet was meant to compute.
+    dots = scorer.movie_vectors(movies) @ scorer.user_embedding[user_encoded]
+    batch_dots = np.add.reduceat(dots, np.arange(0, len(dots), batch_size)) if len(dots) else dots
+    return np.repeat(batch_dots, batch_size)[:len(dots)] + scorer.movie_bias[movies] + scorer.user_bias[user_encoded]
+
+def top_n_indices(scores, top_n):
+    if top_n <= 0:
+        return np.empty(0, dtype = np.int64)
+
+    # Drop excluded entries before selecting
+    candidates = np.flatnonzero(scores > -np.inf)
+    if len(candidates) > top_n:
+        candidates = candidates[np.argpartition(scores[candidates], -top_n)[-top_n:]]
+
+    # Sort only the selected entries by score in descending order
+    return candidates[np.argsort(scores[candidates], kind = 'stable')[::-1]]
+
+def top_n_rows(scores, top_n):
+    # Select the top entries of every row at once
+    top_n = min(top_n, scores.shape[1])
+    if top_n <= 0:
+        return [np.empty(0, dtype = np.int64) for _ in range(len(scores))]
+    candidates = np.argpartition(scores, -top_n, axis = 1)[:, -top_n:]
+    candidate_scores = np.take_along_axis(scores, candidates, axis = 1)
+    order = np.argsort(-candidate_scores, axis = 1, kind = 'stable')
+    candidates = np.take_along_axis(candidates, order, axis = 1)
+    candidate_scores = np.take_along_axis(candidate_scores, order, axis = 1)
+
+    # Drop excluded entries from rows with fewer candidates than top_n
+    return [row[row_scores > -np.inf] for row, row_scores in zip(candidates, candidate_scores)]
+
+class EmbeddingScorer:
+    # Number of users scored per matrix product in batch scoring
+    batch_size = 256
+
+    def __init__(self, user_embedding, user_bias, movie_embedding, movie_bias):
+        self.user_embedding = np.ascontiguousarray(user_embedding, dtype = np.float32)
+        self.user_bias = np.ascontiguousarray(user_bias, dtype = np.float32).reshape(-1)
+        self.movie_embedding = np.ascontiguousarray(movie_embedding, dtype = np.float32)
+        self.movie_bias = np.ascontiguousarray(movie_bias, dtype = np.float32).reshape(-1)
+
+    @classmethod
+    def from_model(cls, path_model):
+        return cls(**load_embedding_weights(path_model))
+
+    @property
+    def num_users(self):
+        return self.user_embedding.shape[0]
+
+    @property
+    def num_movies(self):
+        return self.movie_embedding.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.user_embedding.nbytes + self.user_bias.nbytes + self.movie_embedding.nbytes + self.movie_bias.nbytes
+
+    def with_weights(self, user_embedding, user_bias, movie_embedding, movie_bias):
+        # Scorer of the same kind over new weights
+        return EmbeddingScorer(user_embedding, user_bias, movie_embedding, movie_bias)
+
+    def quantized(self, mode):
+        return QuantizedScorer(self.user_embedding, self.user_bias, self.movie_embedding, self.movie_bias, mode)
+
+    def movie_vectors(self, indices):
+        # float32 embedding rows of the given movies
+        return self.movie_embedding[indices]
+
+    def logits_vector(self, user_vector, user_bias = 0.0):
+        # Scores of a user given by its embedding, trained or folded in from its ratings
+        return self.movie_embedding @ user_vector + self.movie_bias + user_bias
+
+    def logits(self, user_encoded):
+        # Dot product of the user with every movie plus both biases
+        return self.logits_vector(self.user_embedding[user_encoded], self.user_bias[user_encoded])
+
+    def top_n_vector(self, user_vector, user_bias = 0.0, top_n = 10, exclude = None):
+        # Sigmoid is monotonic so ranking on logits gives the same order
+        scores = self.logits_vector(user_vector, user_bias)
+        if exclude is not None:
+            scores[exclude] = -np.inf
+
+        return top_n_indices(scores, top_n)
+
+    def top_n(self, user_encoded, top_n = 10, exclude = None):
+        return self.top_n_vector(self.user_embedding[user_encoded], self.user_bias[user_encoded], top_n, exclude)
+
+    def logits_batch(self, users_encoded):
+        # User x movie matrix product plus both biases
+        return (self.user_embedding[users_encoded] @ self.movie_embedding.T
+                + self.movie_bias[np.newaxis, :] + self.user_bias[users_encoded][:, np.newaxis])
+
+    def top_n_batch(self, users_encoded, top_n = 10, exclude = None):
+        # exclude is a boolean users x movies mask of movies that can not be recommended
+        users_encoded = np.asarray(users_encoded, dtype = np.int64)
+        results = []
+        for start in range(0, len(users_encoded), self.batch_size):
+            stop = start + self.batch_size
+            scores = self.logits_batch(users_encoded[start:stop])
+            if exclude is not None:
+                scores[exclude[start:stop]] = -np.inf
+            results.extend(top_n_rows(scores, top_n))
+
+        return results
+
+def quantize_rows(embedding, mode):
+    # float16 codes, or int8 codes with one float32 scale per row
+    embedding = np.asarray(embedding, dtype = np.float32)
+    if mode == 'float16':
+        return embedding.astype(np.float16), None
+    if mode == 'int8':
+        scales = np.abs(embedding).max(axis = 1) / 127.0 if embedding.size else np.ones(len(embedding))
+        scales[scales == 0] = 1.0
+        return np.round(embedding / scales[:, np.newaxis]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f'unknown quantization {mode!r}, expected float16 or int8')
+
+class QuantizedScorer(EmbeddingScorer):
+    # Movies dequantized one block of rows at a time, so the float32 copy stays small
+    block_size = 8192
+
+    def __init__(self, user_embedding, user_bias, movie_embedding, movie_bias, mode = 'int8'):
+        self.mode = mode
+        self.user_embedding = np.ascontiguousarray(user_embedding, dtype = np.float32)
+        self.user_bias = np.ascontiguousarray(user_bias, dtype = np.float32).reshape(-1)
+        self.movie_codes, self.movie_scales = quantize_rows(movie_embedding, mode)
+        self.movie_bias = np.ascontiguousarray(movie_bias, dtype = np.float32).reshape(-1)
+
+    @property
+    def num_movies(self):
+        return self.movie_codes.shape[0]
+
+    @property
+    def movie_embedding(self):
+        # Full float32 table, for training and building indexes rather than scoring
+        return self.movie_vectors(slice(None))
+
+    @property
+    def nbytes(self):
+        scales = self.movie_scales.nbytes if self.movie_scales is not None else 0
+        return self.user_embedding.nbytes + self.user_bias.nbytes + self.movie_codes.nbytes + scales + self.movie_bias.nbytes
+
+    def with_weights(self, user_embedding, user_bias, movie_embedding, movie_bias):
+        return QuantizedScorer(user_embedding, user_bias, movie_embedding, movie_bias, self.mode)
+
+    def movie_vectors(self, indices):
+        vectors = self.movie_codes[indices].astype(np.float32)
+        if self.movie_scales is not None:
+            vectors *= self.movie_scales[indices][..., np.newaxis]
+        return vectors
+
+    def logits_vector(self, user_vector, user_bias = 0.0):
+        # The int8 scale of each row is applied to its dot product instead of to every element
+        user_vector = np.asarray(user_vector, dtype = np.float32)
+        scores = np.empty(self.num_movies, dtype = np.float32)
+        for start in range(0, self.num_movies, self.block_size):
+            stop = start + self.block_size
+            scores[start:stop] = self.movie_codes[start:stop].astype(np.float32) @ user_vector
+        if self.movie_scales is not None:
+            scores *= self.movie_scales
+        return scores + self.movie_bias + user_bias
+
+    def logits_batch(self, users_encoded):
+        user_rows = self.user_embedding[users_encoded]
+        scores = np.empty((len(user_rows), self.num_movies), dtype = np.float32)
+        for start in range(0, self.num_movies, self.block_size):
+            stop = start + self.block_size
+            scores[:, start:stop] = user_rows @ self.movie_codes[start:stop].astype(np.float32).T
+        if self.movie_scales is not None:
+            scores *= self.movie_scales[np.newaxis, :]
+        return scores + self.movie_bias[np.newaxis, :] + self.user_bias[users_encoded][:, np.newaxis]
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    # python scorer.py keras [path_model]: compare with the saved Keras model the way the baseline called it
+    if sys.argv[1:2] == ['keras']:
+        path_model = sys.argv[2] if len(sys.argv) > 2 else './model'
+        try:
+            import tensorflow as tf
+        except ImportError:
+            tf = None
+            print("TensorFlow is not installed, comparing with the NumPy reproduction of model.predict only")
+
+        scorer = EmbeddingScorer.from_model(path_model)
+        model_keras = tf.keras.models.load_model(path_model) if tf is not None else None
+        movies = np.arange(scorer.num_movies)
+        overlaps, errors, bias_orders = [], [], []
+        for user_encoded in range(min(scorer.num_users, 50)):
+            keras = keras_logits(scorer, user_encoded, movies)
+            if model_keras is not None:
+                # Baseline call: one [user, movie] row per movie, default predict batch size of 32
+                predicted = model_keras.predict(np.column_stack([np.full(len(movies), user_encoded), movies]), verbose = 0).flatten()
+                errors.append(np.abs(predicted - 1.0 / (1.0 + np.exp(-keras))).max())
+                keras = predicted
+            keras_top = movies[np.argsort(keras, kind = 'stable')[-10:][::-1]]
+            top = scorer.top_n(user_encoded, 10)
+            overlaps.append(len(np.intersect1d(keras_top, top)) / 10)
+
+            # Within a predict batch the Keras order is the movie bias order
+            within = keras[:32][np.argsort(scorer.movie_bias[:32], kind = 'stable')]
+            bias_orders.append(bool(np.all(np.diff(within) >= -1e-5)))
+
+        if errors:
+            print(f"Keras predict vs NumPy reproduction: max abs difference {max(errors):.2e}")
+        print(f"top-10 overlap of the served ranking with the Keras ranking: {np.mean(overlaps):.3f}")
+        print(f"Keras order within a predict batch follows the movie bias: {all(bias_orders)}")
+        sys.exit(0)
+
+    # Memory, throughput and top-10 overlap of each mode against float32, on the served model or argv[1] synthetic movies
+    if len(sys.argv) > 1:
+        rng = np.random.default_rng(0)
+        num_movies = int(sys.argv[1])
+        spectrum = 0.3 * 0.85 ** np.arange(50)
+        scorer = EmbeddingScorer(
+            rng.normal(0, 1, (1000, 50)) * spectrum, rng.normal(0, 0.1, 1000),
+            rng.normal(0, 1, (num_movies, 50)) * spectrum, rng.normal(0, 0.3, num_movies))
+    else:
+        from utilities import registry
+        scorer = registry.get('scorer')
+
+    users = np.arange(min(scorer.num_users, 512))
+    exact = scorer.top_n_batch(users, 10)
+    print(f"{scorer.num_users} users, {scorer.num_movies} movies")
+    for mode in ['float32', 'float16', 'int8']:
+        candidate = scorer if mode == 'float32' else scorer.quantized(mode)
+        table_bytes = candidate.nbytes - candidate.user_embedding.nbytes - candidate.user_bias.nbytes - candidate.movie_bias.nbytes
+
+        start = time.perf_counter()
+        single = [candidate.top_n(x, 10) for x in users[:128]]
+        single_rate = 128 / (time.perf_counter() - start)
+        start = time.perf_counter()
+        batch = candidate.top_n_batch(users, 10)
+        batch_rate = len(users) / (time.perf_counter() - start)
+
+        overlap = np.mean([len(np.intersect1d(x, y)) / 10 for x, y in zip(exact, batch)])
+        print(f"{mode:>8}: movie table {table_bytes / 1e6:8.2f} MB, {single_rate:8.0f} users/s single, "
+              f"{batch_rate:8.0f} users/s batched, top-10 overlap {overlap:.3f}")
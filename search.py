@@ -0,0 +1,161 @@
+import bisect
+import re
+import threading
+import unicodedata
+import numpy as np
+
+TOKEN = re.compile(r'[a-z0-9]+')
+
+# MovieLens titles move the leading article to the end: 'Matrix, The (1999)'
+TRAILING_ARTICLE = re.compile(r'^(.*), (the|a|an)( \(\d{4}\))?$', re.IGNORECASE)
+
+# Leading title words kept per movie for ranking titles that start with the query
+LEADING_TOKENS = 4
+
+def tokenize(text):
+    # Lowercase ASCII words, accents dropped so 'Amélie' matches 'amelie'
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode().lower()
+    return TOKEN.findall(text)
+
+def title_tokens(title):
+    # Words of the title in reading order, article first
+    match = TRAILING_ARTICLE.match(title or '')
+    if match:
+        title = f'{match.group(2)} {match.group(1)}{match.group(3) or ""}'
+    return tokenize(title)
+
+class TitleIndex:
+    def __init__(self):
+        # Catalog position -> movieId, encoded movie (-1 until the movie is first rated),
+        # ids of the first title words (-1 padded) and number of non year words
+        self.movie_ids = []
+        self.positions = {}
+        self.encoded = np.empty(0, dtype = np.int64)
+        self.leading = np.empty((0, LEADING_TOKENS), dtype = np.int64)
+        self.word_counts = np.empty(0, dtype = np.int64)
+
+        # token -> id and catalog positions in increasing order, every token sorted for prefix lookups
+        self.token_ids = {}
+        self.postings = {}
+        self.vocabulary = []
+        self.lock = threading.Lock()
+
+        # Matches of the one and two letter prefixes, they expand to thousands of words
+        self.short_prefixes = {}
+
+    @classmethod
+    def from_titles(cls, movie_ids, titles, movie2movie_encoded):
+        index = cls()
+        rows = [index._add(movie_id, title) for movie_id, title in zip(movie_ids, titles)]
+        index.vocabulary = sorted(index.postings)
+        index.encoded = np.array([movie2movie_encoded.get(x, -1) for x in index.movie_ids], dtype = np.int64)
+        index.leading = np.array([x for x, _ in rows], dtype = np.int64).reshape(-1, LEADING_TOKENS)
+        index.word_counts = np.array([x for _, x in rows], dtype = np.int64)
+        return index
+
+    def _add(self, movie_id, title):
+        # Postings of a new title, returns its leading word ids and word count
+        position = len(self.movie_ids)
+        tokens = title_tokens(title)
+        self.movie_ids.append(movie_id)
+        self.positions[movie_id] = position
+        for token in dict.fromkeys(tokens):
+            self.token_ids.setdefault(token, len(self.token_ids))
+            self.postings.setdefault(token, []).append(position)
+        leading = [self.token_ids[x] for x in tokens[:LEADING_TOKENS]]
+        return leading + [-1] * (LEADING_TOKENS - len(leading)), sum(not x.isdigit() for x in tokens)
+
+    def add_movie(self, movie_id, title, movie_encoded = -1):
+        # New catalog movie, searchable right away
+        with self.lock:
+            if movie_id in self.positions:
+                return
+            leading, word_count = self._add(movie_id, title)
+            for token in set(title_tokens(title)):
+                if len(self.postings[token]) == 1:
+                    bisect.insort(self.vocabulary, token)
+            self.encoded = np.append(self.encoded, movie_encoded)
+            self.leading = np.vstack([self.leading, [leading]])
+            self.word_counts = np.append(self.word_counts, word_count)
+            self.short_prefixes.clear()
+
+    def set_encoded(self, movie_id, movie_encoded):
+        # A catalog movie got its first rating
+        position = self.positions.get(movie_id)
+        if position is not None:
+            self.encoded[position] = movie_encoded
+
+    def prefix_words(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        return self.vocabulary[start:bisect.bisect_left(self.vocabulary, prefix + '\x7f', start)]
+
+    def matches(self, token, words = None):
+        # Positions of the titles having the token, or one of the words starting with it,
+        # with 2 for a whole word match and 1 for a prefix match
+        exact = self.postings.get(token, [])
+        if not words or words == [token]:
+            return np.array(exact, dtype = np.int64), np.full(len(exact), 2, dtype = np.int64)
+
+        # The exact word sorts first among the words with the prefix, a title having several keeps its best
+        positions = np.concatenate([self.postings[x] for x in words]).astype(np.int64)
+        positions, first = np.unique(positions, return_index = True)
+        return positions, np.where(first < len(exact), 2, 1)
+
+    def prefix_matches(self, prefix):
+        cached = self.short_prefixes.get(prefix)
+        if cached is None:
+            words = self.prefix_words(prefix)
+            positions, quality = self.matches(prefix, words)
+            cached = words, positions, quality, np.array([self.token_ids[x] for x in words], dtype = np.int64)
+            if len(prefix) <= 2:
+                self.short_prefixes[prefix] = cached
+        return cached
+
+    def search(self, query, mean_rating, top_n = 10):
+        # Catalog positions and mean ratings of the titles having every query word (the last one as a prefix),
+        # by match quality then by mean rating
+        tokens = tokenize(query)
+        if not tokens:
+            return np.empty(0, dtype = np.int64), np.empty(0)
+
+        with self.lock:
+            _, positions, quality, word_ids = self.prefix_matches(tokens[-1])
+            for token in dict.fromkeys(tokens[:-1]):
+                token_positions, token_quality = self.matches(token)
+                keep = np.isin(positions, token_positions, assume_unique = True)
+                positions = positions[keep]
+                quality = quality[keep] + token_quality[np.searchsorted(token_positions, positions)]
+            if len(positions) == 0:
+                return positions, np.empty(0)
+
+            # Titles starting with the query rank first, titles made of the query words only before them
+            if len(tokens) <= LEADING_TOKENS:
+                leading = self.leading[positions]
+                last = len(tokens) - 1
+                starts = np.isin(leading[:, last], word_ids)
+                for column, token in enumerate(tokens[:-1]):
+                    starts &= leading[:, column] == self.token_ids.get(token, -2)
+                whole = starts & (leading[:, last] == self.token_ids.get(tokens[-1], -2)) & (self.word_counts[positions] == len(tokens))
+                quality = quality + 2 * starts + 2 * whole
+            encoded = self.encoded[positions]
+
+        # Unrated movies (and a movie encoded after mean_rating was read) rank as 0
+        rated = (encoded >= 0) & (encoded < len(mean_rating))
+        ratings = np.zeros(len(positions))
+        ratings[rated] = mean_rating[encoded[rated]]
+
+        # Only the candidates tied with or above the top_n-th one are fully sorted, ratings are below 8
+        if len(positions) > top_n:
+            key = quality * 8 + ratings
+            keep = key >= -np.partition(-key, top_n - 1)[top_n - 1]
+            positions, ratings, quality = positions[keep], ratings[keep], quality[keep]
+        order = np.lexsort((positions, -ratings, -quality))[:top_n]
+        return positions[order], ratings[order]
+
+    def movie_ids_of(self, positions):
+        return [self.movie_ids[x] for x in positions]
+
+    @property
+    def nbytes(self):
+        # Posting entries and per movie arrays, the token strings themselves are not counted
+        return sum(len(x) for x in self.postings.values()) * 8 + self.encoded.nbytes + self.leading.nbytes + self.word_counts.nbytes
@@ -0,0 +1,211 @@
+import csv
+import json
+import os
+import re
+import sqlite3
+import time
+import click
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Tables created when seeding an empty database, same schema as the models in app.py
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    "userId" INTEGER NOT NULL PRIMARY KEY,
+    username VARCHAR(50),
+    email VARCHAR(50),
+    password VARCHAR(50)
+);
+CREATE TABLE IF NOT EXISTS movie (
+    "movieId" INTEGER NOT NULL PRIMARY KEY,
+    "movieTitle" VARCHAR(50),
+    "movieGenre" VARCHAR(50),
+    "movieImage" VARCHAR(300)
+);
+CREATE TABLE IF NOT EXISTS user_movie (
+    "userId" INTEGER NOT NULL REFERENCES user ("userId"),
+    "movieId" INTEGER NOT NULL REFERENCES movie ("movieId"),
+    rating FLOAT,
+    "isFavorited" BOOLEAN,
+    "isWatched" BOOLEAN,
+    PRIMARY KEY ("userId", "movieId")
+);
+"""
+
+# Secondary indexes of user_movie, same as UserMovie.__table_args__ in app.py, created after the import
+# so bulk loads into an empty table are not slowed down by index maintenance
+INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_user_movie_movieId ON user_movie ("movieId");
+CREATE INDEX IF NOT EXISTS ix_user_movie_userId_rating ON user_movie ("userId", rating);
+"""
+
+# Insert statements, re-running an import updates rows instead of duplicating them
+INSERTS = {
+    'users': (
+        'INSERT INTO user ("userId", username, email, password) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT ("userId") DO NOTHING'
+    ),
+    'movies': (
+        'INSERT INTO movie ("movieId", "movieTitle", "movieGenre", "movieImage") VALUES (?, ?, ?, ?) '
+        'ON CONFLICT ("movieId") DO UPDATE SET "movieTitle" = excluded."movieTitle", '
+        '"movieGenre" = excluded."movieGenre", "movieImage" = excluded."movieImage"'
+    ),
+    'ratings': (
+        'INSERT INTO user_movie ("userId", "movieId", rating, "isFavorited", "isWatched") VALUES (?, ?, ?, 0, 1) '
+        'ON CONFLICT ("userId", "movieId") DO UPDATE SET rating = excluded.rating'
+    ),
+}
+
+# Map an input record (data/*.json or MovieLens CSV) to the insert parameters
+def user_params(record):
+    return (int(record['userId']), record.get('username'), record.get('email'), record.get('password'))
+
+def movie_params(record):
+    return (
+        int(record['movieId']),
+        record.get('movieTitle', record.get('title')),
+        record.get('movieGenre', record.get('genres')),
+        record.get('movieImage', record.get('image')),
+    )
+
+def rating_params(record):
+    return (int(record['userId']), int(record['movieId']), float(record['rating']))
+
+PARAMS = {'users': user_params, 'movies': movie_params, 'ratings': rating_params}
+
+DEFAULT_PATHS = {
+    'users': os.path.join(basedir, 'data', 'users.json'),
+    'movies': os.path.join(basedir, 'data', 'movies.json'),
+    'ratings': os.path.join(basedir, 'data', 'ratings.json'),
+}
+
+# Whitespace and commas between the objects of a JSON array
+SEPARATORS = re.compile(r'[\s,]*')
+
+def iter_json_array(path, read_size = 1 << 20):
+    # Stream the objects of a top level JSON array without loading the whole file
+    decoder = json.JSONDecoder()
+    with open(path, encoding = 'utf-8') as json_file:
+        buffer = json_file.read(read_size)
+        pos = SEPARATORS.match(buffer).end()
+        if buffer[pos:pos + 1] != '[':
+            raise click.ClickException(f'{path} is not a JSON array')
+        pos += 1
+        eof = False
+        while True:
+            pos = SEPARATORS.match(buffer, pos).end()
+            if buffer[pos:pos + 1] == ']':
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The next object continues in the following chunk
+                chunk = json_file.read(read_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield record
+
+def iter_json_lines(path):
+    with open(path, encoding = 'utf-8') as json_file:
+        for line in json_file:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_csv(path):
+    with open(path, newline = '', encoding = 'utf-8') as csv_file:
+        yield from csv.DictReader(csv_file)
+
+def iter_records(path):
+    if path.endswith('.csv'):
+        return iter_csv(path)
+    if path.endswith(('.jsonl', '.ndjson')):
+        return iter_json_lines(path)
+    return iter_json_array(path)
+
+def connect(db_path):
+    # Autocommit mode, transactions are opened explicitly by import_file
+    connection = sqlite3.connect(db_path, isolation_level = None)
+    connection.executescript(SCHEMA)
+
+    # Bulk load settings: WAL, no fsync per transaction, large page cache
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA temp_store = MEMORY')
+    connection.execute('PRAGMA cache_size = -262144')
+    return connection
+
+def import_file(connection, table, path, batch_size = 50000, transaction_size = 1000000):
+    insert = INSERTS[table]
+    params = PARAMS[table]
+    rows = 0
+    start = time.perf_counter()
+
+    # executemany per batch, one transaction per transaction_size rows
+    batch = []
+    rows_in_transaction = 0
+    connection.execute('BEGIN')
+    for record in iter_records(path):
+        batch.append(params(record))
+        if len(batch) >= batch_size:
+            connection.executemany(insert, batch)
+            rows += len(batch)
+            rows_in_transaction += len(batch)
+            batch = []
+            if rows_in_transaction >= transaction_size:
+                connection.execute('COMMIT')
+                connection.execute('BEGIN')
+                rows_in_transaction = 0
+    if batch:
+        connection.executemany(insert, batch)
+        rows += len(batch)
+    connection.execute('COMMIT')
+
+    return rows, time.perf_counter() - start
+
+def seed(db_path, tables, paths = None, batch_size = 50000):
+    paths = paths or {}
+    connection = connect(db_path)
+    try:
+        for table in tables:
+            path = paths.get(table) or DEFAULT_PATHS[table]
+            if not os.path.exists(path):
+                click.echo(f'{table}: {path} not found, skipped')
+                continue
+            rows, seconds = import_file(connection, table, path, batch_size = batch_size)
+            click.echo(f'{table}: {rows} rows from {path} in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)')
+        connection.executescript(INDEXES)
+    finally:
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.close()
+
+@click.group('seed')
+@click.option('--db', 'db_path', envvar = 'DB_PATH', default = os.path.join(basedir, 'db.sqlite'), show_default = True, show_envvar = True, help = 'SQLite database file.')
+@click.option('--batch-size', default = 50000, show_default = True, help = 'Rows per executemany call.')
+@click.pass_context
+def seed_cli(ctx, db_path, batch_size):
+    """Bulk import users, movies and ratings from JSON, JSON lines or CSV files."""
+    ctx.obj = {'db_path': db_path, 'batch_size': batch_size}
+
+def table_command(table):
+    @seed_cli.command(table, help = f'Import {table} (default: {os.path.relpath(DEFAULT_PATHS[table], basedir)}).')
+    @click.argument('path', required = False)
+    @click.pass_context
+    def command(ctx, path):
+        seed(ctx.obj['db_path'], [table], {table: path}, batch_size = ctx.obj['batch_size'])
+    return command
+
+for table in ('users', 'movies', 'ratings'):
+    table_command(table)
+
+@seed_cli.command('all')
+@click.pass_context
+def seed_all(ctx):
+    """Import users, movies and ratings from the default data files."""
+    seed(ctx.obj['db_path'], ['users', 'movies', 'ratings'], batch_size = ctx.obj['batch_size'])
+
+if __name__ == "__main__":
+    seed_cli()
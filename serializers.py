@@ -0,0 +1,67 @@
+import json
+import numpy as np
+from flask import Response
+from movie_stats import format_rating
+from metrics import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Columns of every movie listing and recommendation
+MOVIE_COLUMNS = ['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage']
+
+def movie_records(data, rating_format = None):
+    with span('records'):
+        # Build the rows straight from the columns instead of boxing each row in a Series
+        columns = [data[column].tolist() for column in MOVIE_COLUMNS]
+
+        # Ratings stay numeric unless the client asks for the formatted strings
+        mean_rating = data['mean_rating'].values
+        if rating_format == 'string':
+            columns[3] = format_rating(mean_rating).tolist()
+        else:
+            columns[3] = np.round(mean_rating.astype(np.float64), 1).tolist()
+
+        return [dict(zip(MOVIE_COLUMNS, row)) for row in zip(*columns)]
+
+def dumps(obj):
+    # JSON bytes, with orjson when it is installed
+    with span('json'):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, separators = (',', ':')).encode()
+
+def json_response(body, status = 200):
+    # body is already serialized JSON bytes
+    return Response(body, status = status, mimetype = 'application/json')
+
+if __name__ == "__main__":
+    import timeit
+    from flask import Flask, jsonify
+    from utilities import movies_frame, registry
+
+    app = Flask(__name__)
+
+    def iterrows_jsonify(data):
+        movies_data = []
+        for index, row in data.iterrows():
+            movies_data.append({
+                "movieId": row['movieId'],
+                "movieTitle": row['movieTitle'],
+                "movieGenre": row['movieGenre'],
+                "mean_rating": format_rating([row['mean_rating']])[0],
+                "movieImage": row['movieImage']
+            })
+        return jsonify(movies_data).get_data()
+
+    # Compare both paths on the recommendation, listing and full catalog sizes
+    movie_stats = registry.get('state').movie_stats
+    with app.app_context():
+        for rows in [10, 20, len(movie_stats.ranked())]:
+            data = movies_frame(movie_stats.ranked()[:rows])
+            number = max(10, 20000 // rows)
+            before = timeit.timeit(lambda: iterrows_jsonify(data), number = number) / number
+            after = timeit.timeit(lambda: dumps(movie_records(data)), number = number) / number
+            print(f"{rows:>6} rows: iterrows + jsonify {before * 1e3:8.3f} ms, records + dumps {after * 1e3:8.3f} ms, {before / after:5.1f}x")
@@ -0,0 +1,57 @@
+import numpy as np
+from scipy import sparse
+
+class SimilarityIndex:
+    def __init__(self, neighbors, scores):
+        # Top-K neighbours of each encoded movie, -1 where a movie has fewer neighbours
+        self.neighbors = np.asarray(neighbors, dtype = np.int32)
+        self.scores = np.asarray(scores, dtype = np.float32)
+
+    @classmethod
+    def from_ratings(cls, users_encoded, movies_encoded, ratings, num_users, num_movies, top_k = 50, block_size = 1024):
+        # Sparse user x movie matrix with L2 normalized movie columns
+        user_item = sparse.csr_matrix(
+            (np.asarray(ratings, dtype = np.float32), (users_encoded, movies_encoded)),
+            shape = (num_users, num_movies))
+        norms = np.sqrt(np.asarray(user_item.multiply(user_item).sum(axis = 0)).ravel())
+        norms[norms == 0] = 1.0
+        item_user = (user_item @ sparse.diags(1.0 / norms).astype(np.float32)).T.tocsr()
+        user_item = item_user.T.tocsc()
+
+        top_k = min(top_k, max(num_movies - 1, 0))
+        neighbors = np.full((num_movies, top_k), -1, dtype = np.int32)
+        scores = np.zeros((num_movies, top_k), dtype = np.float32)
+        if top_k == 0:
+            return cls(neighbors, scores)
+
+        # Cosine similarity of one block of movies against all movies at a time
+        for start in range(0, num_movies, block_size):
+            stop = min(start + block_size, num_movies)
+            block = (item_user[start:stop] @ user_item).toarray()
+            block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+
+            # Keep only the top-K neighbours of each movie in the block
+            candidates = np.argpartition(block, -top_k, axis = 1)[:, -top_k:]
+            candidate_scores = np.take_along_axis(block, candidates, axis = 1)
+            order = np.argsort(-candidate_scores, axis = 1, kind = 'stable')
+            candidates = np.take_along_axis(candidates, order, axis = 1)
+            candidate_scores = np.take_along_axis(candidate_scores, order, axis = 1)
+
+            # Movies without co-ratings are not neighbours
+            valid = candidate_scores > 0
+            neighbors[start:stop] = np.where(valid, candidates, -1)
+            scores[start:stop] = np.where(valid, candidate_scores, 0.0)
+
+        return cls(neighbors, scores)
+
+    @property
+    def nbytes(self):
+        return self.neighbors.nbytes + self.scores.nbytes
+
+    def similar(self, movie_encoded, top_n = 10):
+        # Neighbours of a movie in descending similarity
+        if movie_encoded >= len(self.neighbors):
+            return np.empty(0, dtype = np.int32), np.empty(0, dtype = np.float32)
+        neighbors = self.neighbors[movie_encoded]
+        valid = neighbors >= 0
+        return neighbors[valid][:top_n], self.scores[movie_encoded][valid][:top_n]
@@ -0,0 +1,119 @@
+import json
+import os
+import time
+import click
+import numpy as np
+
+# Each version is a directory of .npy files and a manifest, CURRENT holds the version being served
+MANIFEST_FILE = 'manifest.json'
+CURRENT_FILE = 'CURRENT'
+
+def write_snapshot(root, arrays, metadata):
+    # Write into a staging directory and rename it, a version directory is always complete
+    version = time.strftime('%Y%m%d-%H%M%S')
+    while os.path.exists(os.path.join(root, version)):
+        version += '-1'
+    staging = os.path.join(root, f'.{version}.tmp')
+    os.makedirs(staging)
+
+    files = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        np.save(os.path.join(staging, name + '.npy'), array)
+        files[name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    manifest = {'version': version, 'created': time.time(), 'arrays': files, **metadata}
+    with open(os.path.join(staging, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2)
+
+    os.rename(staging, os.path.join(root, version))
+    return version
+
+def publish(root, version):
+    # Point CURRENT to the version with an atomic rename
+    if not os.path.exists(os.path.join(root, version, MANIFEST_FILE)):
+        raise FileNotFoundError(f'snapshot {version} not found in {root}')
+    staging = os.path.join(root, f'.{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(staging, 'w') as current_file:
+        current_file.write(version)
+    os.replace(staging, os.path.join(root, CURRENT_FILE))
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as current_file:
+            return current_file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def list_versions(root):
+    if not os.path.isdir(root):
+        return []
+    return sorted(x for x in os.listdir(root) if os.path.exists(os.path.join(root, x, MANIFEST_FILE)))
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        self.version = self.manifest['version']
+        self._arrays = {}
+
+    @classmethod
+    def load(cls, root, version = None):
+        # Current version of root, None when nothing was published
+        version = version or current_version(root)
+        if version is None:
+            return None
+        return cls(os.path.join(root, version))
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays']
+
+    def __getitem__(self, name):
+        # Read only memory map, the pages are shared by every process serving this version
+        array = self._arrays.get(name)
+        if array is None:
+            path = os.path.join(self.path, name + '.npy')
+            empty = 0 in self.manifest['arrays'][name]['shape']
+            array = self._arrays[name] = np.load(path) if empty else np.load(path, mmap_mode = 'r')
+        return array
+
+    @property
+    def nbytes(self):
+        return sum(int(np.prod(x['shape'])) * np.dtype(x['dtype']).itemsize for x in self.manifest['arrays'].values())
+
+@click.group('snapshot')
+def snapshot_cli():
+    """Compile the recommender engines into memory mapped snapshots."""
+
+@snapshot_cli.command('compile')
+@click.option('--publish/--no-publish', 'publish_version', default = True, show_default = True, help = 'Serve the new version.')
+def compile_command(publish_version):
+    """Build every engine from the database and model and write a new version."""
+    from utilities import compile_snapshot, path_snapshots
+    start = time.perf_counter()
+    version = compile_snapshot(path_snapshots)
+    snapshot = Snapshot.load(path_snapshots, version)
+    click.echo(f'{version}: {len(snapshot.manifest["arrays"])} arrays, {snapshot.nbytes / 1e6:.1f} MB in {time.perf_counter() - start:.2f}s')
+    if publish_version:
+        publish(path_snapshots, version)
+        click.echo(f'{version} published')
+
+@snapshot_cli.command('publish')
+@click.argument('version')
+def publish_command(version):
+    """Serve VERSION, running servers switch with POST /snapshot/reload."""
+    from utilities import path_snapshots
+    try:
+        publish(path_snapshots, version)
+    except FileNotFoundError as error:
+        raise click.ClickException(str(error))
+    click.echo(f'{version} published')
+
+@snapshot_cli.command('list')
+def list_command():
+    """List the versions, the served one marked with *."""
+    from utilities import path_snapshots
+    current = current_version(path_snapshots)
+    for version in list_versions(path_snapshots):
+        click.echo(f'{"*" if version == current else " "} {version}')
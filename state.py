@@ -0,0 +1,147 @@
+import threading
+import numpy as np
+import pandas as pd
+
+def ratings_csr(users_encoded, movies_encoded, ratings, num_users):
+    # Ratings grouped by encoded user: the movies and ratings of user u are at indptr[u]:indptr[u + 1]
+    order = np.argsort(users_encoded, kind = 'stable')
+    indptr = np.zeros(num_users + 1, dtype = np.int64)
+    np.cumsum(np.bincount(users_encoded, minlength = num_users), out = indptr[1:])
+    return (
+        indptr,
+        np.asarray(movies_encoded, dtype = np.int64)[order],
+        np.asarray(ratings, dtype = np.float64)[order])
+
+class RecommenderState:
+    def __init__(self, user_ids, movie_ids, rating_indptr, rating_movies, rating_values, movie_stats, catalog_movie_ids):
+        # Encoded ids are the positions in user_ids and movie_ids, new ids are appended
+        self.user2user_encoded = {x : i for i, x in enumerate(np.asarray(user_ids).tolist())}
+        self.user_encoded2user = {i : x for x, i in self.user2user_encoded.items()}
+        self.movie2movie_encoded = {x : i for i, x in enumerate(np.asarray(movie_ids).tolist())}
+        self.movie_endcoded2movie = {i : x for x, i in self.movie2movie_encoded.items()}
+        self.movie_stats = movie_stats
+        self.catalog_movie_ids = catalog_movie_ids
+
+        # Callbacks run with the movieId of every newly encoded movie, and with the userId of every rating change
+        self.movie_listeners = []
+        self.rating_listeners = []
+
+        # Ratings at start as CSR by encoded user, read only and possibly memory mapped
+        self.rating_indptr = rating_indptr
+        self.rating_movies = rating_movies
+        self.rating_values = rating_values
+
+        # Ratings of the users changed since start: {userId: {movieId: rating}}
+        self.changed_ratings = {}
+
+        # Id of the last change log row applied, None when the database has no change log
+        self.change_cursor = None
+
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_ratings(cls, ratings_df, user_ids, movie_ids, movie_stats, catalog_movie_ids):
+        # user_ids and movie_ids hold every id of ratings_df, in encoded order
+        rating_indptr, rating_movies, rating_values = ratings_csr(
+            pd.Index(user_ids).get_indexer(ratings_df['userId']),
+            pd.Index(movie_ids).get_indexer(ratings_df['movieId']),
+            ratings_df['rating'].values, len(user_ids))
+        return cls(user_ids, movie_ids, rating_indptr, rating_movies, rating_values, movie_stats, catalog_movie_ids)
+
+    def _base_ratings(self, user_id):
+        # Encoded movies and ratings of the user at start
+        user_encoded = self.user2user_encoded.get(user_id)
+        if user_encoded is None or user_encoded + 1 >= len(self.rating_indptr):
+            return self.rating_movies[:0], self.rating_values[:0]
+        start, stop = self.rating_indptr[user_encoded], self.rating_indptr[user_encoded + 1]
+        return self.rating_movies[start:stop], self.rating_values[start:stop]
+
+    def ratings(self, user_id):
+        # Current ratings of the user as {movieId: rating}
+        changed = self.changed_ratings.get(user_id)
+        if changed is not None:
+            return changed
+        movies_encoded, ratings = self._base_ratings(user_id)
+        movie_endcoded2movie = self.movie_endcoded2movie
+        return {movie_endcoded2movie[x] : y for x, y in zip(movies_encoded.tolist(), ratings.tolist())}
+
+    def watched(self, user_id):
+        # Movies rated by the user
+        return self.ratings(user_id).keys()
+
+    def watched_encoded(self, user_id):
+        # Read under the lock, the changed ratings of the user may be written meanwhile
+        with self.lock:
+            changed = self.changed_ratings.get(user_id)
+            if changed is None:
+                return self._base_ratings(user_id)[0]
+            movie2movie_encoded = self.movie2movie_encoded
+            return np.array([movie2movie_encoded[x] for x in changed], dtype = np.int64)
+
+    def _changed(self, user_id):
+        # Copy the ratings of the user out of the read only arrays on first change
+        changed = self.changed_ratings.get(user_id)
+        if changed is None:
+            changed = self.changed_ratings[user_id] = dict(self.ratings(user_id))
+        return changed
+
+    def _encode_user(self, user_id):
+        if user_id not in self.user2user_encoded:
+            user_encoded = len(self.user2user_encoded)
+            self.user2user_encoded[user_id] = user_encoded
+            self.user_encoded2user[user_encoded] = user_id
+
+    def _encode_movie(self, movie_id):
+        movie_encoded = self.movie2movie_encoded.get(movie_id)
+        if movie_encoded is None:
+            movie_encoded = len(self.movie2movie_encoded)
+            self.movie_stats.add_movie(movie_id, movie_id in self.catalog_movie_ids)
+            self.movie2movie_encoded[movie_id] = movie_encoded
+            self.movie_endcoded2movie[movie_encoded] = movie_id
+            for listener in self.movie_listeners:
+                listener(movie_id)
+        return movie_encoded
+
+    def _ratings_changed(self, user_id):
+        for listener in self.rating_listeners:
+            listener(user_id)
+
+    def set_rating(self, user_id, movie_id, rating):
+        # Apply a created or updated rating as a delta
+        with self.lock:
+            self._encode_user(user_id)
+            movie_encoded = self._encode_movie(movie_id)
+
+            ratings = self._changed(user_id)
+            previous = ratings.get(movie_id)
+            ratings[movie_id] = rating
+
+            if previous is None:
+                self.movie_stats.update(movie_encoded, rating, 1)
+            else:
+                self.movie_stats.update(movie_encoded, rating - previous, 0)
+            self._ratings_changed(user_id)
+
+    def remove_rating(self, user_id, movie_id):
+        # Apply a deleted rating, nothing happens when the rating is already gone
+        with self.lock:
+            previous = self._changed(user_id).pop(movie_id, None)
+            if previous is not None:
+                self.movie_stats.update(self.movie2movie_encoded[movie_id], -previous, -1)
+                self._ratings_changed(user_id)
+
+    def ratings_arrays(self):
+        # Encoded users, encoded movies and ratings of every current rating
+        with self.lock:
+            num_base_users = len(self.rating_indptr) - 1
+            users_encoded = np.repeat(np.arange(num_base_users, dtype = np.int64), np.diff(self.rating_indptr))
+            changed_encoded = [self.user2user_encoded[x] for x in self.changed_ratings]
+            keep = ~np.isin(users_encoded, changed_encoded)
+            user_ids, movie_ids, ratings = [users_encoded[keep]], [self.rating_movies[keep]], [self.rating_values[keep]]
+
+            # The changed users come from their copies
+            for user_id, movie_ratings in self.changed_ratings.items():
+                user_ids.append(np.full(len(movie_ratings), self.user2user_encoded[user_id], dtype = np.int64))
+                movie_ids.append(np.array([self.movie2movie_encoded[x] for x in movie_ratings], dtype = np.int64))
+                ratings.append(np.array(list(movie_ratings.values()), dtype = np.float64))
+        return np.concatenate(user_ids), np.concatenate(movie_ids), np.concatenate(ratings)
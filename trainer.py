@@ -0,0 +1,146 @@
+import threading
+import numpy as np
+from fold_in import MIN_RATING, MAX_RATING, fold_in
+
+def grow(array, rows, fill):
+    # Copy of array with rows added at the end, the published one is never written to
+    return np.concatenate([array, fill((rows - len(array),) + array.shape[1:]).astype(np.float32)])
+
+class OnlineTrainer:
+    # SGD over the embedding rows of the new ratings only, a few epochs per batch
+    learning_rate = 0.05
+    regularization = 1e-4
+    epochs = 5
+
+    # Movies new to the model are folded in with their bias held near zero like the trained ones,
+    # a movie with a single high rating would otherwise outrank the whole catalog
+    movie_bias_regularization = 1e3
+
+    # Seconds between two reads of new ratings, and ratings read at most per step
+    interval = 60.0
+    batch_size = 100000
+
+    def __init__(self, engines, checkpoint, read_ratings):
+        # read_ratings(after, limit) returns up to limit user_movie rows with rowid > after, in rowid order
+        self.engines = engines
+        self.checkpoint = checkpoint
+        self.read_ratings = read_ratings
+        self.on_publish = None
+
+        self.rows_trained = 0
+        self.publishes = 0
+        self.last_loss = None
+        self.last_error = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, on_publish = None):
+        # on_publish is called with {userId: [movieId, ...]} of every trained batch
+        self.on_publish = on_publish
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.run, name = 'online-trainer', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                while self.step() == self.batch_size and not self.stopped.is_set():
+                    pass
+                self.last_error = None
+            except Exception as error:
+                self.last_error = error
+
+    def step(self):
+        # Train on the ratings added since the checkpoint and publish a new scorer, returns the rows read
+        ratings_df = self.read_ratings(self.checkpoint, self.batch_size)
+        if len(ratings_df) == 0:
+            return 0
+        user_ids = ratings_df['userId'].tolist()
+        movie_ids = ratings_df['movieId'].tolist()
+        ratings = ratings_df['rating'].values.astype(np.float32)
+
+        # Encode new ids, ratings written by other processes also reach this process's state
+        recommender_state = self.engines.get('state')
+        for user_id, movie_id, rating in zip(user_ids, movie_ids, ratings.tolist()):
+            recommender_state.set_rating(user_id, movie_id, rating)
+        users = np.array([recommender_state.user2user_encoded[x] for x in user_ids], dtype = np.int64)
+        movies = np.array([recommender_state.movie2movie_encoded[x] for x in movie_ids], dtype = np.int64)
+
+        # Grown copies of the tables with a row for every encoded id, not only the ones of this batch:
+        # new users start from their vector folded in from the known movies, then new movies from their raters
+        scorer = self.engines.get('scorer')
+        num_users = max(scorer.num_users, len(recommender_state.user2user_encoded))
+        num_movies = max(scorer.num_movies, len(recommender_state.movie2movie_encoded))
+        user_embedding = grow(scorer.user_embedding, num_users, np.zeros)
+        user_bias = grow(scorer.user_bias, num_users, np.zeros)
+        movie_embedding = grow(scorer.movie_embedding, num_movies, np.zeros)
+        movie_bias = grow(scorer.movie_bias, num_movies, np.zeros)
+        fold_in_cache = self.engines.get('fold_in')
+        for user_encoded in range(scorer.num_users, num_users):
+            folded = fold_in_cache.get(recommender_state.user_encoded2user[user_encoded], scorer)
+            if folded is not None:
+                user_embedding[user_encoded], user_bias[user_encoded] = folded
+        if num_movies > scorer.num_movies:
+            self.fold_in_movies(recommender_state, scorer.num_movies, user_embedding, user_bias, movie_embedding, movie_bias)
+
+        # Mean squared error of the sigmoid output on the normalized rating, the loss the model was trained with
+        # (model/keras_metadata.pb); d/dlogit of (p - t)^2 is 2 (p - t) p (1 - p), duplicate rows add up
+        targets = (ratings - MIN_RATING) / (MAX_RATING - MIN_RATING)
+        for _ in range(self.epochs):
+            user_rows, movie_rows = user_embedding[users], movie_embedding[movies]
+            logits = np.einsum('ij,ij->i', user_rows, movie_rows) + user_bias[users] + movie_bias[movies]
+            predictions = 1.0 / (1.0 + np.exp(-logits))
+            error = (2.0 * (predictions - targets) * predictions * (1.0 - predictions))[:, np.newaxis]
+            np.add.at(user_embedding, users, -self.learning_rate * (error * movie_rows + self.regularization * user_rows))
+            np.add.at(movie_embedding, movies, -self.learning_rate * (error * user_rows + self.regularization * movie_rows))
+            np.add.at(user_bias, users, -self.learning_rate * error[:, 0])
+            np.add.at(movie_bias, movies, -self.learning_rate * error[:, 0])
+        self.last_loss = float(np.mean((predictions - targets) ** 2))
+
+        # Requests switch to the new scorer on their next lookup, an approximate index already built gets the new movies
+        self.engines.publish('scorer', scorer.with_weights(user_embedding, user_bias, movie_embedding, movie_bias))
+        ann_index = self.engines.peek('ann')
+        if ann_index is not None:
+            self.engines.publish('ann', ann_index.with_movies(movie_embedding, movie_bias))
+        self.checkpoint = int(ratings_df['rowid'].iloc[-1])
+        self.rows_trained += len(ratings_df)
+        self.publishes += 1
+
+        if self.on_publish is not None:
+            trained = {}
+            for user_id, movie_id in zip(user_ids, movie_ids):
+                trained.setdefault(user_id, []).append(movie_id)
+            self.on_publish(trained)
+        return len(ratings_df)
+
+    def fold_in_movies(self, recommender_state, start, user_embedding, user_bias, movie_embedding, movie_bias):
+        # Vector and bias of the movies from start on, from the vectors of the users who rated them;
+        # ids encoded by a rating made since the tables were grown wait for the next step
+        users_encoded, movies_encoded, ratings = recommender_state.ratings_arrays()
+        new = (movies_encoded >= start) & (movies_encoded < len(movie_embedding)) & (users_encoded < len(user_embedding))
+        users_encoded, movies_encoded, ratings = users_encoded[new], movies_encoded[new], ratings[new]
+        order = np.argsort(movies_encoded, kind = 'stable')
+        movies, starts = np.unique(movies_encoded[order], return_index = True)
+        for movie_encoded, rows in zip(movies, np.split(order, starts[1:])):
+            raters = users_encoded[rows]
+            movie_embedding[movie_encoded], movie_bias[movie_encoded] = fold_in(
+                user_embedding[raters], user_bias[raters], ratings[rows], bias_regularization = self.movie_bias_regularization)
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'checkpoint': self.checkpoint,
+            'rows_trained': self.rows_trained,
+            'publishes': self.publishes,
+            'last_loss': self.last_loss,
+            'last_error': repr(self.last_error) if self.last_error is not None else None,
+        }
@@ -1,183 +1,616 @@
 import sqlite3
 import pandas as pd
 import os
-import tensorflow as tf
 import numpy as np
 import json
+import threading
+from scorer import EmbeddingScorer, WEIGHT_NAMES
+from movie_stats import MovieStats
+from state import RecommenderState, ratings_csr
+from similarity import SimilarityIndex
+from cold_start import ColdStartEngine
+from genre_index import GenreIndex
+from engines import EngineRegistry
+from snapshot import Snapshot, write_snapshot, current_version
+from ann import IVFIndex
+from precompute import PrecomputedRecommendations
+from fold_in import FoldInCache
+from trainer import OnlineTrainer
+from batcher import MicroBatcher
+from search import TitleIndex
+from changes import ChangeFeed, CHANGE_LOG
+from metrics import span
 
-# Read database
-connection = sqlite3.connect('./db.sqlite')
+# Every artifact is built on first use (or warmed in the background), not on import
+registry = EngineRegistry()
 
-query_movies = "select * from movie"
-movies_df = pd.read_sql_query(query_movies, connection)
+# Movies added through the API update the movies frame, the catalog and the search index one at a time
+catalog_lock = threading.Lock()
 
-query_ratings = "select * from user_movie"
-ratings_df = pd.read_sql_query(query_ratings, connection)
+# Snapshot and precomputed versions read by the last engines built, to tell when a new one is published
+served_versions = {}
 
-connection.close()
+# Read database, the paths can point at another dataset such as a generated benchmark one
+path_db = os.environ.get('DB_PATH', './db.sqlite')
+path_model = os.environ.get('MODEL_PATH', './model')
+path_snapshots = os.environ.get('SNAPSHOT_PATH', './snapshots')
+path_precomputed = os.environ.get('PRECOMPUTED_PATH', './precomputed')
 
-user_ids = ratings_df['userId'].unique().tolist()
-user2user_encoded = {x : i for i, x in enumerate(user_ids)}
-user_encoded2user = {i : x for i, x in enumerate(user_ids)}
+# Optional float16 or int8 movie embeddings for scoring
+SCORER_QUANTIZATION = os.environ.get('SCORER_QUANTIZATION')
 
-movie_ids = ratings_df['movieId'].unique().tolist()
-movie2movie_encoded = {x : i for i, x in enumerate(movie_ids)}
-movie_endcoded2movie = {i : x for i, x in enumerate(movie_ids)}
+# Changes pending past this are not replayed, the engines are rebuilt from the database instead
+CHANGE_FEED_MAX_PENDING = int(os.environ.get('CHANGE_FEED_MAX_PENDING', 100000))
 
-# A new user has just signed in
-from sklearn.metrics.pairwise import cosine_similarity
+# Precomputed recommendations older than this (seconds) are not served
+PRECOMPUTED_MAX_AGE = float(os.environ.get('PRECOMPUTED_MAX_AGE', 6 * 3600))
 
-# One-hot encode the movie genres
-genres_df = movies_df['movieGenre'].str.get_dummies()
+# Catalogs with at least this many movies are scored through the approximate index, n_probe lists per request
+ANN_MIN_MOVIES = int(os.environ.get('ANN_MIN_MOVIES', 100000))
+ANN_PROBES = int(os.environ.get('ANN_PROBES', IVFIndex.n_probe))
 
-# Combine the ratings and genres data
-movies_data = pd.concat([movies_df['movieId'], genres_df], axis = 1)
+def read_sql(query, params = None):
+  connection = sqlite3.connect(path_db)
+  try:
+    with span('sqlite'):
+      return pd.read_sql_query(query, connection, params = params)
+  finally:
+    connection.close()
 
-ratings_data = pd.merge(ratings_df, movies_data, on = 'movieId')
+def read_ratings_fingerprint():
+  # Changes whenever a rating is added, updated or deleted
+  connection = sqlite3.connect(path_db)
+  try:
+    return list(connection.execute("select count(*), total(rating), max(rowid) from user_movie").fetchone())
+  finally:
+    connection.close()
 
-# Update
-ratings_count = ratings_data.groupby('movieId')['rating'].count().reset_index()
-ratings_count.columns = ['movieId', 'ratings_count']
-ratings_data = ratings_data.merge(ratings_count, on = 'movieId', how = 'left')
-# Create a user-item matrix
-user_item_matrix = ratings_data.pivot_table(index = 'userId', columns = 'movieId', values = 'rating').fillna(0)
+def read_new_ratings(after, limit):
+  return read_sql("select rowid, userId, movieId, rating from user_movie where rowid > ? order by rowid limit ?", (after, limit))
 
-# Compute the movie similarities
-movie_similarities = cosine_similarity(user_item_matrix.T)
+def create_change_log():
+  # Log table and triggers, left out on a read only database (or before the tables are seeded)
+  connection = sqlite3.connect(path_db)
+  try:
+    connection.executescript(CHANGE_LOG)
+  except sqlite3.OperationalError:
+    pass
+  finally:
+    connection.close()
 
-# Load model
-path_model = './model'
-model_keras = tf.keras.models.load_model(path_model)
+def read_change_cursor():
+  # Id of the last logged change, pruned or not, None when the database has no change log
+  connection = sqlite3.connect(path_db)
+  try:
+    connection.execute("select 1 from change_log limit 1")
+    row = connection.execute("select seq from sqlite_sequence where name = 'change_log'").fetchone()
+    return row[0] if row is not None else 0
+  except sqlite3.OperationalError:
+    return None
+  finally:
+    connection.close()
+
+def read_changes(after, limit):
+  connection = sqlite3.connect(path_db)
+  try:
+    with span('sqlite'):
+      return connection.execute(
+        'select id, kind, "userId", "movieId", rating from change_log where id > ? order by id limit ?', (after, limit)).fetchall()
+  finally:
+    connection.close()
+
+def prune_changes(before):
+  # Every process applied these long ago, or rebuilds from the database when it finds them gone
+  connection = sqlite3.connect(path_db, timeout = 15)
+  try:
+    with connection:
+      connection.execute('delete from change_log where "changedAt" < ?', (before,))
+  except sqlite3.OperationalError:
+    pass
+  finally:
+    connection.close()
+
+def extend_ids(known_ids, ids):
+  # Known ids keep their encoding, the new ones are appended in order of appearance
+  new_ids = pd.unique(np.asarray(ids))
+  return np.concatenate([known_ids, new_ids[~np.isin(new_ids, known_ids)]]).astype(np.int64)
+
+@registry.register('snapshot')
+def build_snapshot(engines):
+  # Published snapshot, memory mapped, or None to build everything from the database
+  snapshot = Snapshot.load(path_snapshots)
+  served_versions['snapshot'] = snapshot.version if snapshot is not None else None
+  return snapshot
+
+@registry.register('movies')
+def build_movies(engines):
+  # Movie details by movieId
+  return read_sql("select * from movie").set_index('movieId')
+
+@registry.register('state')
+def build_state(engines):
+  snapshot = engines.get('snapshot')
+  catalog_movie_ids = set(engines.get('movies').index)
+
+  # Changes logged after this are applied by the change feed, the ones read twice are applied again to the same result
+  change_cursor = read_change_cursor()
+
+  # Ratings unchanged since the snapshot was compiled are read from it
+  if snapshot is not None and snapshot.manifest['ratings_fingerprint'] == read_ratings_fingerprint():
+    movie_ids = snapshot['movie_ids']
+    movie_stats = MovieStats(
+      movie_ids, snapshot['ratings_sum'], snapshot['ratings_count'],
+      np.isin(movie_ids, np.fromiter(catalog_movie_ids, dtype = np.int64)), min_votes = snapshot.manifest['min_votes'])
+    recommender_state = RecommenderState(
+      snapshot['user_ids'], movie_ids, snapshot['rating_indptr'], snapshot['rating_movies'], snapshot['rating_values'],
+      movie_stats, catalog_movie_ids)
+    recommender_state.change_cursor = change_cursor
+    return recommender_state
+
+  ratings_df = read_sql("select * from user_movie")
+
+  # Keep the encoding of the snapshot, the model and the other arrays are aligned with it
+  if snapshot is not None:
+    user_ids = extend_ids(snapshot['user_ids'], ratings_df['userId'])
+    movie_ids = extend_ids(snapshot['movie_ids'], ratings_df['movieId'])
+  else:
+    user_ids = ratings_df['userId'].unique()
+    movie_ids = ratings_df['movieId'].unique()
+  movie2movie_encoded = {x : i for i, x in enumerate(movie_ids.tolist())}
+
+  # Rating statistics of each movie, aligned by encoded movie index
+  movie_stats = MovieStats.from_ratings(ratings_df, movie2movie_encoded, catalog_movie_ids)
+
+  # Rating changes made through the API are applied to the in-memory state
+  recommender_state = RecommenderState.from_ratings(ratings_df, user_ids, movie_ids, movie_stats, catalog_movie_ids)
+  recommender_state.change_cursor = change_cursor
+  return recommender_state
+
+@registry.register('genre_index')
+def build_genre_index(engines):
+  # Index the movies of each genre
+  snapshot = engines.get('snapshot')
+  movies_by_id = engines.get('movies')
+  recommender_state = engines.get('state')
+  with recommender_state.lock:
+    movie_genres = movies_by_id['movieGenre'].reindex(recommender_state.movie_stats.movie_ids).fillna('')
+    if snapshot is not None:
+      genre_index = GenreIndex(snapshot.manifest['genre_names'], snapshot['genre_masks'])
+      for movie_genre in movie_genres.values[genre_index.num_movies:]:
+        genre_index.add_movie(movie_genre)
+    else:
+      genre_index = GenreIndex.from_genres(movie_genres)
+    recommender_state.movie_listeners.append(
+      lambda movie_id: genre_index.add_movie(engines.get('movies')['movieGenre'].get(movie_id, '')))
+  return genre_index
+
+@registry.register('search')
+def build_search(engines):
+  # Typeahead over the catalog titles, a movie rated for the first time starts ranking by its mean rating
+  movies_by_id = engines.get('movies')
+  recommender_state = engines.get('state')
+  with recommender_state.lock:
+    search_index = TitleIndex.from_titles(movies_by_id.index.tolist(), movies_by_id['movieTitle'].tolist(), recommender_state.movie2movie_encoded)
+    recommender_state.movie_listeners.append(
+      lambda movie_id: search_index.set_encoded(movie_id, recommender_state.movie2movie_encoded[movie_id]))
+  return search_index
+
+@registry.register('cold_start')
+def build_cold_start(engines):
+  # A new user has just signed in
+  return ColdStartEngine(engines.get('genre_index'))
+
+def load_scorer(engines):
+  # Load model, full precision
+  snapshot = engines.get('snapshot')
+  if snapshot is not None:
+    return EmbeddingScorer(**{name : snapshot[name] for name in WEIGHT_NAMES})
+  return EmbeddingScorer.from_model(path_model)
+
+@registry.register('scorer')
+def build_scorer(engines):
+  # Quantized only for serving
+  scorer = load_scorer(engines)
+  return scorer.quantized(SCORER_QUANTIZATION) if SCORER_QUANTIZATION else scorer
+
+@registry.register('ann')
+def build_ann(engines):
+  # Inverted lists over the movie embeddings with the bias folded in
+  snapshot = engines.get('snapshot')
+  if snapshot is not None and 'ann_centroids' in snapshot:
+    return IVFIndex(snapshot['ann_centroids'], snapshot['ann_offsets'], snapshot['ann_items'])
+  scorer = engines.get('scorer')
+  return IVFIndex.from_embeddings(scorer.movie_embedding, scorer.movie_bias)
+
+@registry.register('precomputed')
+def build_precomputed(engines):
+  # Published output of flask precompute, None when missing or computed with another movie encoding
+  precomputed = PrecomputedRecommendations.load(path_precomputed)
+  served_versions['precomputed'] = precomputed.version if precomputed is not None else None
+  if precomputed is None or not precomputed.matches(engines.get('state').movie_stats.movie_ids):
+    return None
+  return precomputed
+
+@registry.register('fold_in')
+def build_fold_in(engines):
+  # Vectors of the users the model was not trained on, recomputed after each of their rating changes
+  recommender_state = engines.get('state')
+  fold_in_cache = FoldInCache(recommender_state)
+  recommender_state.rating_listeners.append(fold_in_cache.invalidate)
+  return fold_in_cache
+
+@registry.register('trainer')
+def build_trainer(engines):
+  # Trains on the ratings added after the snapshot (or after this process started), the weights are not saved
+  snapshot = engines.get('snapshot')
+  if snapshot is not None:
+    checkpoint = snapshot.manifest['ratings_fingerprint'][2]
+  else:
+    checkpoint = read_ratings_fingerprint()[2]
+  return OnlineTrainer(engines, checkpoint or 0, read_new_ratings)
+
+@registry.register('similarity')
+def build_similarity(engines):
+  snapshot = engines.get('snapshot')
+  if snapshot is not None:
+    return SimilarityIndex(snapshot['similarity_neighbors'], snapshot['similarity_scores'])
+
+  # Compute the top-K most similar movies of each movie from a sparse user-item matrix
+  recommender_state = engines.get('state')
+  users_encoded, movies_encoded, ratings = recommender_state.ratings_arrays()
+  return SimilarityIndex.from_ratings(
+    users_encoded, movies_encoded, ratings, len(recommender_state.user2user_encoded), len(recommender_state.movie2movie_encoded))
+
+def compile_snapshot(root):
+  # Build every engine from the database and the model, then write them as a new version;
+  # the weights are written at full precision whatever SCORER_QUANTIZATION is
+  engines = registry.copy({'snapshot': lambda engines: None, 'scorer': load_scorer})
+  recommender_state = engines.get('state')
+  movie_stats = recommender_state.movie_stats
+  scorer = engines.get('scorer')
+  genre_index = engines.get('genre_index')
+  similarity_index = engines.get('similarity')
+  ann_index = engines.get('ann')
+
+  num_users = len(recommender_state.user2user_encoded)
+  users_encoded, movies_encoded, ratings = recommender_state.ratings_arrays()
+  rating_indptr, rating_movies, rating_values = ratings_csr(users_encoded, movies_encoded, ratings, num_users)
+  arrays = {
+    'user_ids': np.array([recommender_state.user_encoded2user[i] for i in range(num_users)], dtype = np.int64),
+    'movie_ids': movie_stats.movie_ids,
+    'rating_indptr': rating_indptr,
+    'rating_movies': rating_movies,
+    'rating_values': rating_values,
+    'ratings_sum': movie_stats.ratings_sum,
+    'ratings_count': movie_stats.ratings_count,
+    'genre_masks': genre_index.masks,
+    'similarity_neighbors': similarity_index.neighbors,
+    'similarity_scores': similarity_index.scores,
+    'ann_centroids': ann_index.centroids,
+    'ann_offsets': ann_index.list_offsets,
+    'ann_items': ann_index.list_items,
+  }
+  arrays.update({name : getattr(scorer, name) for name in WEIGHT_NAMES})
+
+  return write_snapshot(root, arrays, {
+    'ratings_fingerprint': read_ratings_fingerprint(),
+    'min_votes': movie_stats.min_votes,
+    'genre_names': genre_index.genre_names,
+  })
+
+def start_online_training(on_publish = None):
+  registry.get('trainer').start(on_publish)
+
+def reload_snapshot():
+  # Build the engines of the published snapshot next to the served ones and switch in one step
+  trainer = registry.peek('trainer')
+  if trainer is not None and trainer.running:
+    trainer.stop()
+    registry.swap(registry.copy())
+    registry.get('trainer').start(trainer.on_publish)
+  else:
+    registry.swap(registry.copy())
+  snapshot = registry.get('snapshot')
+  return snapshot.version if snapshot is not None else None
+
+def normalize_genres(genres):
+  # Sorted set of the comma separated genres, used as a cache key
+  return tuple(sorted({x.strip().lower() for x in genres.split(',')}))
+
+def rating_change_tags(user_id, movie_ids):
+  # Cache tags of the responses that a rating change can affect
+  movies_by_id = registry.get('movies')
+  tags = {('all',), ('user', user_id)}
+  for movie_id in movie_ids:
+    tags.add(('movie', movie_id))
+    movie_genre = movies_by_id['movieGenre'].get(movie_id)
+    for genre in movie_genre.split('|') if movie_genre else []:
+      tags.add(('genre', genre.lower()))
+  return tags
+
+def apply_changes(recommender_state, changes):
+  # Apply (kind, userId, movieId, rating) changes to the state in order, returns the cache tags they affect
+  tags = set()
+  new_movie_ids = []
+  for kind, user_id, movie_id, rating in changes:
+    if kind == 'movie':
+      new_movie_ids.append(movie_id)
+      continue
+    if kind == 'rating':
+      recommender_state.set_rating(user_id, movie_id, rating)
+    else:
+      recommender_state.remove_rating(user_id, movie_id)
+    tags |= rating_change_tags(user_id, [movie_id])
+
+  # Movies added through another process, read back from the database
+  if new_movie_ids:
+    new_movies = read_sql(f"select * from movie where movieId in ({','.join('?' * len(new_movie_ids))})", new_movie_ids)
+    for movie in new_movies.itertuples(index = False):
+      add_catalog_movie(movie.movieId, movie.movieTitle, movie.movieGenre, movie.movieImage)
+  return tags
+
+def sync_changes(on_change):
+  # Bring this process up to date with the writes of every process: switch to a newly published snapshot or
+  # precomputed table, then apply the change log past the state's cursor. on_change gets the cache tags of the
+  # applied changes, or None after a rebuild. Returns the changes applied, None when the database has no change log
+  if 'snapshot' in served_versions and current_version(path_snapshots) != served_versions['snapshot']:
+    reload_snapshot()
+    on_change(None)
+  elif 'precomputed' in served_versions and current_version(path_precomputed) != served_versions['precomputed']:
+    registry.publish('precomputed', build_precomputed(registry))
+    on_change(None)
+
+  # Nothing to apply before the state is built, it reads the database when it is
+  recommender_state = registry.peek('state')
+  if recommender_state is None:
+    return 0
+  cursor = recommender_state.change_cursor
+  if cursor is None:
+    return None
+
+  # Changes pruned before this process read them, or too many to replay one by one: rebuild from the database
+  changes = read_changes(cursor, CHANGE_FEED_MAX_PENDING)
+  if changes and changes[0][0] != cursor + 1 or len(changes) == CHANGE_FEED_MAX_PENDING:
+    reload_snapshot()
+    on_change(None)
+    return len(changes)
+
+  if changes:
+    on_change(apply_changes(recommender_state, [x[1:] for x in changes]))
+    recommender_state.change_cursor = changes[-1][0]
+  return len(changes)
+
+def structure_sizes():
+  # Bytes held by the engines built so far, memory mapped snapshot arrays included
+  sizes = {}
+  recommender_state = registry.peek('state')
+  if recommender_state is not None:
+    movie_stats = recommender_state.movie_stats
+    sizes['ratings'] = recommender_state.rating_indptr.nbytes + recommender_state.rating_movies.nbytes + recommender_state.rating_values.nbytes
+    sizes['movie_stats'] = sum(x.nbytes for x in movie_stats.buffers.values())
+  movies_by_id = registry.peek('movies')
+  if movies_by_id is not None:
+    sizes['movies'] = int(movies_by_id.memory_usage(index = True, deep = True).sum())
+  for name, structure in [('embeddings', 'scorer'), ('similarity', 'similarity'), ('ann_index', 'ann')]:
+    engine = registry.peek(structure)
+    if engine is not None:
+      sizes[name] = engine.nbytes
+  genre_index = registry.peek('genre_index')
+  if genre_index is not None:
+    sizes['genre_index'] = genre_index.masks.nbytes
+  precomputed = registry.peek('precomputed')
+  if precomputed is not None:
+    sizes['precomputed'] = precomputed.movies.nbytes
+  search_index = registry.peek('search')
+  if search_index is not None:
+    sizes['search'] = search_index.nbytes
+  return sizes
+
+def movies_not_recommendable(user_id, scorer):
+  # Watched movies and movies missing from the catalog, among the movies known to the scorer of the request
+  # (the trainer may have published a larger one since)
+  recommender_state = registry.get('state')
+  exclude = ~recommender_state.movie_stats.in_catalog[:scorer.num_movies]
+  watched = recommender_state.watched_encoded(user_id)
+  exclude[watched[watched < scorer.num_movies]] = True
+  return exclude
+
+def recommendable(user_id, movies_encoded):
+  # Which of the encoded movies are in the catalog and not rated by the user
+  recommender_state = registry.get('state')
+  watched = recommender_state.watched_encoded(user_id)
+  return recommender_state.movie_stats.in_catalog[movies_encoded] & ~np.isin(movies_encoded, watched)
+
+def movies_frame(indices):
+  # Movie details and mean rating of the given encoded movies, in order
+  movie_stats = registry.get('state').movie_stats
+  movies_by_id = registry.get('movies')
+  with span('movies_frame'):
+    indices = np.asarray(indices, dtype = np.int64)
+    result_data = movies_by_id.loc[movie_stats.movie_ids[indices], ['movieTitle', 'movieGenre', 'movieImage']].reset_index()
+    result_data['mean_rating'] = movie_stats.mean[indices]
+    return result_data[['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage']]
 
 def get_all_movies_has_rating(top_n = 20):
-  # Caculate mean rating of each movie
-  movie_ratings = ratings_data.groupby('movieId')['rating'].mean().to_frame()
-  
-  # Handle mean ratings with two column: movieId and mean_rating
-  result_data = movie_ratings.reset_index().rename(columns={'rating': 'mean_rating'})
-  
-  # Format the mean_rating column
-  result_data['mean_rating'] = result_data['mean_rating'].apply(lambda x: f"{x:.1f}")
-  
-  # Merge necessary column
-  result_data = pd.merge(result_data, movies_df[['movieId', 'movieTitle', 'movieGenre', 'movieImage']], on='movieId')
-  
-  # Sort by mean rating in descending order and get top 20
-  result_data = result_data.sort_values(by='mean_rating', ascending=False)
-  result_data = result_data.head(top_n)
-  
-  # return ratings_mean
-  return result_data
-
-def get_movies_by_genre_utilities(genre, top_n = 20):
-    # Caculate mean rating of each movie
-  movie_ratings = ratings_data.groupby('movieId')['rating'].mean().to_frame()
-  
-  # Handle mean ratings with two column: movieId and mean_rating
-  result_data = movie_ratings.reset_index().rename(columns={'rating': 'mean_rating'})
-  
-  # Format the mean_rating column
-  result_data['mean_rating'] = result_data['mean_rating'].apply(lambda x: f"{x:.1f}")
-  
-  # Merge necessary column
-  result_data = pd.merge(result_data, movies_df[['movieId', 'movieTitle', 'movieGenre', 'movieImage']], on='movieId')
-  
-  # Filter by genre
-  result_data = result_data[result_data['movieGenre'].str.contains(genre, case=False)]
-  
-  # Sort by mean rating in descending order and get top 20
-  result_data = result_data.sort_values(by='mean_rating', ascending=False)
-  result_data = result_data.head(top_n)
-  
-  # return ratings_mean
-  return result_data
-
-def predict_new_user(genres, top_n=10, movie_data = movies_data):
+  # Movies are already sorted by mean rating in descending order
+  return movies_frame(registry.get('state').movie_stats.ranked()[:top_n])
+
+def best_rated_movies(top_n = 20):
+  # Fallback of an overloaded or late recommendation, never waits: the last listing order of the built state,
+  # possibly missing the latest ratings, or no movies while the state is still being built
+  recommender_state = registry.peek('state')
+  if recommender_state is None or registry.peek('movies') is None:
+    return pd.DataFrame(columns = ['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage'])
+  return movies_frame(recommender_state.movie_stats.last_ranked[:top_n])
+
+def get_movies_by_genre_utilities(genre, top_n = 20, match_all = False):
+  # Movies having any (or all) of the comma separated genres, sorted by mean rating
+  genres_list = genre.split(',')
+  order = registry.get('state').movie_stats.ranked()
+  genre_index = registry.get('genre_index')
+  with span('genre_index'):
+    ranked = genre_index.ranked(genres_list, order, match_all = match_all)[:top_n]
+  return movies_frame(ranked)
+
+def get_similar_movies(movie_id, top_n = 10):
+  # Unknown movies have no neighbours
+  recommender_state = registry.get('state')
+  movie_encoded = recommender_state.movie2movie_encoded.get(movie_id)
+  if movie_encoded is None:
+    return None
+
+  # Movies first rated after the index was built have no neighbours yet
+  similarity_index = registry.get('similarity')
+  if movie_encoded >= len(similarity_index.neighbors):
+    return movies_frame([])
+
+  # Neighbours that are missing from the catalog can not be shown, at most the K kept per movie
+  top_n = max(1, min(top_n, similarity_index.neighbors.shape[1]))
+  with span('similarity'):
+    neighbors, _ = similarity_index.similar(movie_encoded, top_n = similarity_index.neighbors.shape[1])
+    neighbors = neighbors[recommender_state.movie_stats.in_catalog[neighbors]]
+  return movies_frame(neighbors[:top_n])
+
+def search_movies(query, top_n = 10):
+  # Catalog movies having every typed word in their title (the last one as a prefix), best matches first
+  search_index = registry.get('search')
+  movie_stats = registry.get('state').movie_stats
+  with span('search'):
+    positions, mean_rating = search_index.search(query, movie_stats.mean, top_n)
+    movie_ids = search_index.movie_ids_of(positions)
+
+  # The movies frame is read after the index so it has every movie the index returned
+  movies_by_id = registry.get('movies')
+  with span('movies_frame'):
+    rows = movies_by_id.index.get_indexer(movie_ids)
+    return pd.DataFrame({
+      'movieId': movie_ids,
+      'movieTitle': movies_by_id['movieTitle'].values[rows],
+      'movieGenre': movies_by_id['movieGenre'].values[rows],
+      'mean_rating': mean_rating,
+      'movieImage': movies_by_id['movieImage'].values[rows],
+    })
+
+def add_catalog_movie(movie_id, movie_title, movie_genre, movie_image):
+  # A movie inserted into the movie table is shown and searchable without rebuilding the engines.
+  # Engines built after the insert already read it from the database, so it is only appended where missing
+  with catalog_lock:
+    movies_by_id = registry.get('movies')
+    recommender_state = registry.get('state')
+    search_index = registry.get('search')
+    if movie_id not in movies_by_id.index:
+      new_movie = pd.DataFrame(
+        {'movieTitle': [movie_title], 'movieGenre': [movie_genre], 'movieImage': [movie_image]},
+        index = pd.Index([movie_id], name = 'movieId'))
+      registry.publish('movies', pd.concat([movies_by_id, new_movie]))
+
+    with recommender_state.lock:
+      recommender_state.catalog_movie_ids.add(movie_id)
+      movie_encoded = recommender_state.movie2movie_encoded.get(movie_id, -1)
+      if movie_encoded >= 0:
+        recommender_state.movie_stats.set_in_catalog(movie_encoded, True)
+
+    if movie_id not in search_index.positions:
+      search_index.add_movie(movie_id, movie_title, movie_encoded)
+
+def predict_new_user(genres, top_n=10):
   # Split the genres string into a list of genres
   genres_list = genres.split(',')
-  
-  # Filter the movie data by the specified genres
-  genre_movies_df = movie_data[movie_data[genres_list].isin([1]).any(axis=1)]
-
-  # Compute the average rating for each movie
-  movie_ratings = ratings_data.groupby('movieId')['rating'].mean().to_frame()
-
-  # Handle mean ratings with two column: movieId and mean_rating
-  ratings_mean = movie_ratings.reset_index()
-  ratings_mean = movie_ratings.reset_index().rename(columns={'rating': 'mean_rating'})
-
-  # Compute the number of ratings for each movie
-  movie_ratings_count = ratings_data.groupby('movieId')['rating'].count().to_frame()
-  
-  # # Combine the movie ratings and counts data
-  movie_data = pd.merge(movie_ratings, movie_ratings_count, on='movieId')
-  movie_data = pd.merge(movie_data, movies_df[['movieId', 'movieTitle']], on='movieId')
-  movie_data = pd.merge(movie_data, genre_movies_df, on='movieId')
-  
-  # Merge with the rating data
-  movie_data = pd.merge(movie_data, ratings_data[['movieId', 'rating', 'ratings_count']], on='movieId')
-  
-  # Compute the weighted average rating for each movie
-  movie_data['weighted_rating'] = (movie_data['rating'] * movie_data['ratings_count']) / (movie_data['ratings_count'] + 1000)
-
-  # Compute the similarity between the selected genres and all movies
-  genre_vector = genre_movies_df.mean().values.reshape(1, -1)
-  similarity_scores = cosine_similarity(genre_vector, movie_data.iloc[:, 4:-2].values)[0]
-
-  # Sort the movies by their similarity score and weighted rating
-  movie_data['similarity_score'] = similarity_scores
-  movie_data = movie_data.sort_values(['similarity_score', 'weighted_rating'], ascending=False)
-  movie_data.drop_duplicates(subset='movieId', keep='first', inplace=True)
-  
-  # Result
-  recommended_movies = movie_data
-  recommended_movies = pd.merge(recommended_movies, ratings_mean[['movieId', 'mean_rating']], on='movieId')
-  recommended_movies = recommended_movies[recommended_movies['mean_rating'] > 4.0]
-  recommended_movies = pd.merge(recommended_movies, movies_df[['movieId', 'movieGenre', 'movieImage']], on='movieId')
-  recommended_movies = recommended_movies.head(top_n)
-
-  # Format the mean_rating column
-  recommended_movies['mean_rating'] = recommended_movies['mean_rating'].apply(lambda x: f"{x:.1f}")
-
-  # return json.dumps(recommended_movies[['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage']].to_dict('records'),indent=4)
-  return recommended_movies[['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage']]
+
+  # Sort the movies having the genres by their similarity score and weighted rating
+  movie_stats = registry.get('state').movie_stats
+  cold_start = registry.get('cold_start')
+  with span('cold_start'):
+    recommended_movies = cold_start.recommend(genres_list, movie_stats, top_n = top_n)
+
+  return movies_frame(recommended_movies)
+
+def score_users_batch(requests):
+  # (user_encoded, top_n, exclude) of concurrent predictions, scored as one user x movie matrix
+  scorer = registry.get('scorer')
+  exclude = np.ones((len(requests), scorer.num_movies), dtype = bool)
+  for row, (_, _, mask) in enumerate(requests):
+    # The scorer may have grown since the mask was made, movies it did not cover are left out
+    exclude[row, :len(mask)] = mask[:scorer.num_movies]
+  top_ratings_indices = scorer.top_n_batch([x[0] for x in requests], max(x[1] for x in requests), exclude = exclude)
+  return [x[:top_n] for x, (_, top_n, _) in zip(top_ratings_indices, requests)]
+
+# Polls the change log and the published versions every CHANGE_FEED_INTERVAL seconds once started
+change_feed = ChangeFeed(sync_changes, prune_changes)
+change_feed.interval = float(os.environ.get('CHANGE_FEED_INTERVAL', ChangeFeed.interval))
+
+# Concurrent predictions arriving within MICRO_BATCH_WAIT_MS (or MICRO_BATCH_SIZE of them) are scored together
+batcher = MicroBatcher(
+  score_users_batch, max_batch_size = int(os.environ.get('MICRO_BATCH_SIZE', 64)),
+  max_wait = float(os.environ.get('MICRO_BATCH_WAIT_MS', 2)) / 1000) if os.environ.get('MICRO_BATCH') == '1' else None
 
 # User has ratings before
 def predict_user_has_rating(user_id, top_n = 10):
-  # Compute the average rating for each movie
-  movie_ratings = ratings_data.groupby('movieId')['rating'].mean().to_frame()
-  
-  # Handle mean ratings with two column: movieId and mean_rating
-  ratings_mean = movie_ratings.reset_index()
-  ratings_mean = movie_ratings.reset_index().rename(columns = {'rating' : 'mean_rating'})
-  
   # Recommend movie
-  movies_watched_by_user = ratings_df[ratings_df.userId == user_id]
-  movies_not_watched = movies_df[
-    ~movies_df['movieId'].isin(movies_watched_by_user.movieId.values)]['movieId']
-  movies_not_watched = list(
-    set(movies_not_watched).intersection(set(movie2movie_encoded.keys())))
-  
-  movies_not_watched = [[movie2movie_encoded.get(x)] for x in movies_not_watched]
-  user_encoder = user2user_encoded.get(user_id)
-  user_movie_array = np.hstack(
-      ([[user_encoder]] * len(movies_not_watched), movies_not_watched)
-  )
-
-  ratings = model_keras.predict(user_movie_array).flatten()
-
-  top_ratings_indices = ratings.argsort()[-top_n:][::-1]
-  recommended_movie_ids = [
-      movie_endcoded2movie.get(movies_not_watched[x][0]) for x in top_ratings_indices
-  ]
-  recommended_movies = movies_df[movies_df['movieId'].isin(recommended_movie_ids)]
-  recommended_movies = pd.merge(recommended_movies, ratings_mean[['movieId', 'mean_rating']], on='movieId')
-  
-  # Format the mean_rating column
-  recommended_movies['mean_rating'] = recommended_movies['mean_rating'].apply(lambda x: f"{x:.1f}")
-
-  # return recommended_movies[['movieId', 'title', 'genres', 'mean_rating', 'weighted_rating', 'similarity_score']]
-  return recommended_movies[['movieId', 'movieTitle', 'movieGenre', 'mean_rating', 'movieImage']]
+  scorer = registry.get('scorer')
+  user_encoder = registry.get('state').user2user_encoded.get(user_id)
+
+  if user_encoder is not None and user_encoder < scorer.num_users:
+    # Serve the precomputed recommendations, less the movies rated or dropped from the catalog since they were computed
+    # (ratings made before a restart, a reload or through another worker are not told apart), while top_n of them remain
+    precomputed = registry.get('precomputed')
+    if precomputed is not None and precomputed.age < PRECOMPUTED_MAX_AGE and top_n <= precomputed.top_n:
+      with span('precomputed'):
+        top_ratings_indices = precomputed.get(user_id, user_encoder)
+        if top_ratings_indices is not None:
+          top_ratings_indices = top_ratings_indices[recommendable(user_id, top_ratings_indices)][:top_n]
+      if top_ratings_indices is not None and len(top_ratings_indices) == top_n:
+        return movies_frame(top_ratings_indices)
+
+    user_vector, user_bias = scorer.user_embedding[user_encoder], scorer.user_bias[user_encoder]
+  else:
+    # Users the model was not trained on get a vector folded in from their ratings
+    fold_in_cache = registry.get('fold_in')
+    with span('fold_in'):
+      folded = fold_in_cache.get(user_id, scorer)
+    if folded is None:
+      # No ratings yet, recommend the best rated movies
+      return get_all_movies_has_rating(top_n)
+    user_vector, user_bias = folded
+
+  # Score the user against every movie at once, or only against the candidates of the approximate index
+  with span('exclude'):
+    exclude = movies_not_recommendable(user_id, scorer)
+  if scorer.num_movies >= ANN_MIN_MOVIES:
+    ann_index = registry.get('ann')
+    with span('score_ann'):
+      top_ratings_indices = ann_index.top_n(scorer, user_vector, top_n, exclude = exclude, n_probe = ANN_PROBES)
+  elif batcher is not None and user_encoder is not None and user_encoder < scorer.num_users:
+    with span('score_batched'):
+      top_ratings_indices = batcher.submit((user_encoder, top_n, exclude)).result()
+  else:
+    with span('score'):
+      top_ratings_indices = scorer.top_n_vector(user_vector, user_bias, top_n, exclude = exclude)
+
+  return movies_frame(top_ratings_indices)
+
+# Many users that have ratings before
+def predict_users_batch(user_ids, top_n = 10):
+  # Users known to the model are scored together
+  scorer = registry.get('scorer')
+  user2user_encoded = registry.get('state').user2user_encoded
+  known_user_ids = [x for x in dict.fromkeys(user_ids) if user2user_encoded.get(x, scorer.num_users) < scorer.num_users]
+
+  # One user x movie matrix per block of the scorer's batch size, with the mask of watched movies
+  # and movies missing from the catalog of that block only
+  recommendations = {}
+  for start in range(0, len(known_user_ids), scorer.batch_size):
+    block = known_user_ids[start:start + scorer.batch_size]
+    with span('exclude'):
+      exclude = np.stack([movies_not_recommendable(x, scorer) for x in block])
+    with span('score'):
+      top_ratings_indices = scorer.top_n_batch([user2user_encoded[x] for x in block], top_n, exclude = exclude)
+    recommendations.update(zip(block, top_ratings_indices))
+
+  # The others one by one, through their folded in vectors
+  return [
+    (x, movies_frame(recommendations[x]) if x in recommendations else predict_user_has_rating(x, top_n))
+    for x in user_ids]
 
 if __name__ == "__main__":
   userId = 611